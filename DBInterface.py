@@ -1,153 +1,366 @@
 import aiosqlite
 
-from models import AlertRequest, Subscription, GuildSubscriptionConfig
+from Metrics import metrics
+
+
+# Applied to the shared connection on open. WAL lets the startup reads and the
+# steady trickle of small writes avoid blocking each other, and NORMAL
+# synchronous is durable across application crashes under WAL.
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA cache_size=-16000;",
+    "PRAGMA busy_timeout=5000;",
+]
+
+# Size of sqlite3's per-connection prepared statement cache, up from its
+# default of 128. Statements are cached by their SQL text; all but the sharded
+# startup loads are constant strings, so the hot ones stay compiled.
+CACHED_STATEMENTS = 256
+
+# Rows fetched per round trip to the connection thread when loading on startup
+LOAD_CHUNK_SIZE = 5000
+
+TABLE_COLUMNS = {
+    "alert_requests": (
+        "user_id",
+        "guild_id",
+        "requester_id",
+        "channel_id",
+        "message_id",
+        "expires_at",
+    ),
+    "subscriptions": ("user_id", "guild_id"),
+    "guild_subscription_configs": (
+        "guild_id",
+        "subscription_channel_id",
+        "digest_window",
+        "digest_size",
+        "alert_ttl",
+        "webhook_id",
+        "webhook_token",
+    ),
+}
+
+# Load order for tables feeding the watch store's sorted indexes. In primary
+# key order, user IDs come up in ascending order, so every index entry is
+# appended at the end instead of inserted into the middle.
+TABLE_ORDER = {
+    "alert_requests": "ORDER BY user_id, guild_id, requester_id",
+    "subscriptions": "ORDER BY user_id, guild_id",
+}
+
+# Columns added after a table was first released, and their types. These are
+# added to existing databases on startup.
+MIGRATIONS = {
+    "alert_requests": [
+        ("expires_at", "REAL"),
+    ],
+    "guild_subscription_configs": [
+        ("digest_window", "REAL"),
+        ("digest_size", "INTEGER"),
+        ("alert_ttl", "REAL"),
+        ("webhook_id", "INTEGER"),
+        ("webhook_token", "TEXT"),
+    ],
+}
+
+ALERT_UPSERT = "INSERT OR REPLACE INTO alert_requests({}) VALUES ({});".format(
+    ", ".join(TABLE_COLUMNS["alert_requests"]),
+    ", ".join("?" * len(TABLE_COLUMNS["alert_requests"])),
+)
+
+CONFIG_UPSERT = (
+    "INSERT OR REPLACE INTO guild_subscription_configs({}) VALUES ({});".format(
+        ", ".join(TABLE_COLUMNS["guild_subscription_configs"]),
+        ", ".join("?" * len(TABLE_COLUMNS["guild_subscription_configs"])),
+    )
+)
 
 
 class DBInterface:
     def __init__(self, db_fp):
-        self.conn = lambda: aiosqlite.connect(db_fp)
+        self.db_fp = db_fp
+        self.conn = None
 
+    async def connect(self):
+        if self.conn:
+            return self.conn
+
+        self.conn = await aiosqlite.connect(
+            self.db_fp, cached_statements=CACHED_STATEMENTS
+        )
+        for p in PRAGMAS:
+            await self.conn.execute(p)
+
+        return self.conn
+
+    async def close(self):
+        if not self.conn:
+            return
+
+        conn = self.conn
+        self.conn = None
+        await conn.close()
+
+    async def _write(self, query, params):
+        await self.conn.execute(query, params)
+        await self.conn.commit()
+
+    @metrics.timed("db_initialize_database")
     async def initialize_database(self):
-        # Create tables if first start and return all channels to monitor
-        async with self.conn() as db:
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS alert_requests(
-                    user_id INTEGER,
-                    guild_id INTEGER,
-                    requester_id INTEGER,
-                    channel_id INTEGER,
-                    message_id INTEGER,
-                    PRIMARY KEY (user_id, guild_id, requester_id)                 
-                );
-                """
-            )
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS subscriptions(
-                    user_id INTEGER,
-                    guild_id INTEGER,
-                    PRIMARY KEY (user_id, guild_id)                 
-                );
-                """
-            )
-            await db.execute(
-                """
-                CREATE TABLE IF NOT EXISTS guild_subscription_configs(
-                    guild_id INTEGER PRIMARY KEY,
-                    subscription_channel_id INTEGER
-                );
-                """
-            )
-            await db.commit()
+        # Create tables if first start. Their contents are read with iter_table.
+        db = await self.connect()
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS alert_requests(
+                user_id INTEGER,
+                guild_id INTEGER,
+                requester_id INTEGER,
+                channel_id INTEGER,
+                message_id INTEGER,
+                PRIMARY KEY (user_id, guild_id, requester_id)                 
+            );
+            """
+        )
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS subscriptions(
+                user_id INTEGER,
+                guild_id INTEGER,
+                PRIMARY KEY (user_id, guild_id)                 
+            );
+            """
+        )
+        await db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS guild_subscription_configs(
+                guild_id INTEGER PRIMARY KEY,
+                subscription_channel_id INTEGER
+            );
+            """
+        )
 
-            ret = {}
+        for table, columns in MIGRATIONS.items():
+            async with db.execute(f"PRAGMA table_info({table});") as cursor:
+                existing = set(r[1] for r in await cursor.fetchall())
 
-            for i, u in [
-                ("alert_requests", AlertRequest),
-                ("subscriptions", Subscription),
-                ("guild_subscription_configs", GuildSubscriptionConfig),
-            ]:
-                # Should I be worrying about injection here? Should I forego the loop and just manually run each query?
-                async with db.execute(f"SELECT * FROM {i};") as cursor:
-                    row = await cursor.fetchall()
+            for column, kind in columns:
+                if not column in existing:
+                    await db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {kind};")
 
-                ret[i] = [u(*r) for r in row]
+        await db.commit()
 
-        return ret
+    async def iter_table(self, table, shard_count=None, shard_ids=None):
+        # Yields the table's rows as lists of tuples, LOAD_CHUNK_SIZE at a time,
+        # so a cold start never holds more than one chunk of raw rows.
+        # If shard_ids is given, only rows for guilds on those shards are read.
+        where = ""
+        params = ()
+        if shard_ids is not None:
+            # Discord's shard assignment: (guild_id >> 22) % shard_count
+            where = (
+                f"WHERE ((guild_id >> 22) % ?) IN ({', '.join('?' * len(shard_ids))})"
+            )
+            params = (shard_count, *shard_ids)
+
+        # Table and column names only ever come from TABLE_COLUMNS, never from input
+        columns = ", ".join(TABLE_COLUMNS[table])
+        order = TABLE_ORDER.get(table, "")
+        async with self.conn.execute(
+            f"SELECT {columns} FROM {table} {where} {order};", params
+        ) as cursor:
+            while True:
+                rows = await cursor.fetchmany(LOAD_CHUNK_SIZE)
+                if not rows:
+                    break
+                yield rows
 
+    @metrics.timed("db_insert_alert_request")
     async def insert_alert_request(
-        self, user_id, guild_id, requester_id, channel_id, message_id
+        self, user_id, guild_id, requester_id, channel_id, message_id, expires_at=None
     ):
-        async with self.conn() as db:
-            await db.execute(
-                """
-                INSERT INTO alert_requests(user_id, guild_id, requester_id, channel_id, message_id) VALUES (?, ?, ?, ?, ?);
-                """,
-                (user_id, guild_id, requester_id, channel_id, message_id),
-            )
-            await db.commit()
+        await self._write(
+            ALERT_UPSERT,
+            (user_id, guild_id, requester_id, channel_id, message_id, expires_at),
+        )
 
+    @metrics.timed("db_upsert_alert_requests")
+    async def upsert_alert_requests(self, rows):
+        # rows: iterable of TABLE_COLUMNS["alert_requests"] values, written in one transaction
+        await self.conn.executemany(ALERT_UPSERT, rows)
+        await self.conn.commit()
+
+    @metrics.timed("db_update_alert_request")
     async def update_alert_request(
-        self, user_id, guild_id, requester_id, channel_id, message_id
+        self, user_id, guild_id, requester_id, channel_id, message_id, expires_at=None
     ):
-        async with self.conn() as db:
-            await db.execute(
-                """
-                UPDATE
-                    alert_requests
-                SET
-                    channel_id = ?,
-                    message_id = ?
-                WHERE
-                    user_id = ? AND
-                    guild_id = ? AND
-                    requester_id = ?
-                """,
-                (channel_id, message_id, user_id, guild_id, requester_id),
-            )
-            await db.commit()
+        await self._write(
+            """
+            UPDATE
+                alert_requests
+            SET
+                channel_id = ?,
+                message_id = ?,
+                expires_at = ?
+            WHERE
+                user_id = ? AND
+                guild_id = ? AND
+                requester_id = ?
+            """,
+            (channel_id, message_id, expires_at, user_id, guild_id, requester_id),
+        )
 
+    @metrics.timed("db_remove_alert_request")
     async def remove_alert_request(self, user_id, guild_id, requester_id):
-        async with self.conn() as db:
-            await db.execute(
-                """
-                DELETE FROM
-                    alert_requests
-                WHERE
-                    user_id = ? AND
-                    guild_id = ? AND
-                    requester_id = ?
-                """,
-                (user_id, guild_id, requester_id),
-            )
-            await db.commit()
+        await self._write(
+            """
+            DELETE FROM
+                alert_requests
+            WHERE
+                user_id = ? AND
+                guild_id = ? AND
+                requester_id = ?
+            """,
+            (user_id, guild_id, requester_id),
+        )
+
+    @metrics.timed("db_remove_alert_requests")
+    async def remove_alert_requests(self, keys):
+        # keys: iterable of (user_id, guild_id, requester_id), deleted in one transaction
+        await self.conn.executemany(
+            """
+            DELETE FROM
+                alert_requests
+            WHERE
+                user_id = ? AND
+                guild_id = ? AND
+                requester_id = ?
+            """,
+            keys,
+        )
+        await self.conn.commit()
 
+    @metrics.timed("db_remove_fulfilled_alert_requests")
+    async def remove_fulfilled_alert_requests(self, rows):
+        # rows: iterable of (user_id, guild_id, requester_id, message_id). Only
+        # deletes requests that still carry the message ID they were fulfilled
+        # with, so a request re-made in the meantime survives.
+        await self.conn.executemany(
+            """
+            DELETE FROM
+                alert_requests
+            WHERE
+                user_id = ? AND
+                guild_id = ? AND
+                requester_id = ? AND
+                message_id IS ?
+            """,
+            rows,
+        )
+        await self.conn.commit()
+
+    @metrics.timed("db_insert_subscription")
     async def insert_subscription(self, user_id, guild_id):
-        async with self.conn() as db:
-            await db.execute(
-                """
-                INSERT INTO subscriptions(user_id, guild_id) VALUES (?, ?);
-                """,
-                (user_id, guild_id),
-            )
-            await db.commit()
+        await self._write(
+            """
+            INSERT INTO subscriptions(user_id, guild_id) VALUES (?, ?);
+            """,
+            (user_id, guild_id),
+        )
 
+    @metrics.timed("db_insert_subscriptions")
+    async def insert_subscriptions(self, keys):
+        # keys: iterable of (user_id, guild_id), inserted in one transaction
+        await self.conn.executemany(
+            """
+            INSERT OR IGNORE INTO subscriptions(user_id, guild_id) VALUES (?, ?);
+            """,
+            keys,
+        )
+        await self.conn.commit()
+
+    @metrics.timed("db_remove_subscription")
     async def remove_subscription(self, user_id, guild_id):
-        async with self.conn() as db:
-            await db.execute(
-                """
-                DELETE FROM
-                    subscriptions
-                WHERE
-                    user_id = ? AND
-                    guild_id = ?;
-                """,
-                (user_id, guild_id),
-            )
-            await db.commit()
-
-    async def insert_guild_subscription_config(self, guild_id, subscription_channel_id):
-        async with self.conn() as db:
-            await db.execute(
-                """
-                INSERT INTO guild_subscription_configs(guild_id, subscription_channel_id) VALUES (?, ?);
-                """,
-                (guild_id, subscription_channel_id),
-            )
-            await db.commit()
-
-    async def update_guild_subscription_config(self, guild_id, subscription_channel_id):
-        async with self.conn() as db:
-            await db.execute(
-                """
-                UPDATE
-                    guild_subscription_configs
-                SET
-                    subscription_channel_id = ?
-                WHERE
-                    guild_id = ?;
-                """,
-                (subscription_channel_id, guild_id),
-            )
-            await db.commit()
+        await self._write(
+            """
+            DELETE FROM
+                subscriptions
+            WHERE
+                user_id = ? AND
+                guild_id = ?;
+            """,
+            (user_id, guild_id),
+        )
+
+    @metrics.timed("db_remove_subscriptions")
+    async def remove_subscriptions(self, keys):
+        # keys: iterable of (user_id, guild_id), deleted in one transaction
+        await self.conn.executemany(
+            """
+            DELETE FROM
+                subscriptions
+            WHERE
+                user_id = ? AND
+                guild_id = ?;
+            """,
+            keys,
+        )
+        await self.conn.commit()
+
+    @metrics.timed("db_upsert_guild_subscription_config")
+    async def upsert_guild_subscription_config(self, *row):
+        # row: values for TABLE_COLUMNS["guild_subscription_configs"]
+        await self._write(CONFIG_UPSERT, row)
+
+    @metrics.timed("db_apply_batch")
+    async def apply_batch(
+        self,
+        alert_upserts=(),
+        alert_deletes=(),
+        subscription_inserts=(),
+        subscription_deletes=(),
+        config_upserts=(),
+    ):
+        # Applies a coalesced set of writes in a single transaction. Keys never
+        # appear in more than one list for the same table, so order is irrelevant.
+        try:
+            if alert_upserts:
+                await self.conn.executemany(ALERT_UPSERT, alert_upserts)
+            if alert_deletes:
+                await self.conn.executemany(
+                    """
+                    DELETE FROM
+                        alert_requests
+                    WHERE
+                        user_id = ? AND
+                        guild_id = ? AND
+                        requester_id = ?
+                    """,
+                    alert_deletes,
+                )
+            if subscription_inserts:
+                await self.conn.executemany(
+                    """
+                    INSERT OR IGNORE INTO subscriptions(user_id, guild_id) VALUES (?, ?);
+                    """,
+                    subscription_inserts,
+                )
+            if subscription_deletes:
+                await self.conn.executemany(
+                    """
+                    DELETE FROM
+                        subscriptions
+                    WHERE
+                        user_id = ? AND
+                        guild_id = ?;
+                    """,
+                    subscription_deletes,
+                )
+            if config_upserts:
+                await self.conn.executemany(CONFIG_UPSERT, config_upserts)
+            await self.conn.commit()
+        except:
+            await self.conn.rollback()
+            raise
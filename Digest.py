@@ -0,0 +1,56 @@
+import asyncio
+
+from Dispatch import SUBSCRIPTION, MAX_EMBEDS, MAX_EMBED_CHARS
+
+
+class DigestBuffer:
+    # Collects forwarded embeds per subscription channel and sends them as a
+    # single message once `window` seconds have passed since the first one,
+    # or as soon as `size` of them are waiting. A digest that would go over
+    # Discord's embed character limit is sent before the new embed is added.
+
+    def __init__(self, dispatcher):
+        self.dispatcher = dispatcher
+        # channel_id -> [channel, embeds, timer, characters in embeds]
+        self.buffers = {}
+        # Embeds waiting across all of them
+        self.waiting = 0
+
+    def pending(self):
+        return self.waiting
+
+    def add(self, channel, embed, window, size=None):
+        chars = len(embed)
+
+        buf = self.buffers.get(channel.id)
+        if buf and buf[3] + chars > MAX_EMBED_CHARS:
+            self.flush(channel.id)
+            buf = None
+
+        if not buf:
+            timer = asyncio.get_running_loop().call_later(
+                window, self.flush, channel.id
+            )
+            buf = self.buffers[channel.id] = [channel, [], timer, 0]
+
+        buf[1].append(embed)
+        buf[3] += chars
+        self.waiting += 1
+
+        if len(buf[1]) >= min(size or MAX_EMBEDS, MAX_EMBEDS):
+            self.flush(channel.id)
+
+    def flush(self, channel_id):
+        buf = self.buffers.pop(channel_id, None)
+        if not buf:
+            return
+
+        channel, embeds, timer, _ = buf
+        timer.cancel()
+        self.waiting -= len(embeds)
+
+        self.dispatcher.submit(channel, SUBSCRIPTION, embeds=embeds)
+
+    def flush_all(self):
+        for channel_id in list(self.buffers):
+            self.flush(channel_id)
@@ -0,0 +1,300 @@
+import asyncio
+import collections
+import sys
+import time
+import traceback
+
+import disnake as discord
+
+import util
+from Metrics import metrics
+
+# Send priorities, most urgent first
+ALERT = 0
+SUBSCRIPTION = 1
+
+# Discord allows 10 embeds per message, and 6000 characters across them
+MAX_EMBEDS = 10
+MAX_EMBED_CHARS = 6000
+
+
+def log_exception(e):
+    print(
+        "".join(traceback.TracebackException.from_exception(e).format()),
+        file=sys.stderr,
+    )
+
+
+def deliver(dispatcher, digests, guild, embed, subscription=None, alerts=()):
+    # Hands a rendered sighting to the dispatcher and returns a future for each
+    # alert, resolving to whether it was sent.
+    # subscription: (channel, digest_window, digest_size) or None
+    # alerts: [(channel, requester_ids, message_ids)]
+    step = util.BUTTONS_PER_MESSAGE
+    if subscription:
+        channel, digest_window, digest_size = subscription
+        if digest_window:
+            digests.add(channel, embed, digest_window, digest_size)
+        else:
+            dispatcher.submit(channel, SUBSCRIPTION, embed=embed)
+
+    futures = []
+    for channel, requester_ids, message_ids in alerts:
+        # A message holds BUTTONS_PER_MESSAGE jump buttons, so very popular
+        # targets are announced over several messages
+        sends = [
+            dispatcher.submit(
+                channel,
+                ALERT,
+                " ".join(f"<@{r}>" for r in requester_ids[i : i + step]),
+                embed=embed,
+                components=util.build_jump_rows(
+                    guild, channel, message_ids[i : i + step]
+                ),
+            )
+            for i in range(0, len(requester_ids), step)
+        ]
+        if len(sends) > 1:
+            sends = [asyncio.ensure_future(_all_sent(sends))]
+        futures.append(sends[0])
+
+    return futures
+
+
+async def _all_sent(futures):
+    # Whether every one of several sends went out
+    return all(await asyncio.gather(*futures))
+
+
+class DirectDispatcher:
+    # Sends straight to Discord, allowing at most `concurrency` requests in
+    # flight at once. A failed send is logged and reported as False so that
+    # one bad channel never takes the rest of a fan-out down with it.
+
+    def __init__(self, concurrency=5):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.pending = 0
+        self.tasks = set()
+
+    def submit(self, channel, priority, content=None, **kwargs):
+        # Start sending in the background, returning a task that resolves to
+        # whether the message went out. Priority is ignored.
+        task = asyncio.create_task(self.send(channel, content, **kwargs))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def close(self):
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def send(self, channel, *args, **kwargs):
+        self.pending += 1
+        try:
+            return await self._send(channel, *args, **kwargs)
+        finally:
+            self.pending -= 1
+
+    async def _send(self, channel, *args, **kwargs):
+        async with self.semaphore:
+            try:
+                with metrics.timer("send"):
+                    await channel.send(*args, **kwargs)
+            except Exception as e:
+                metrics.inc("send_failures")
+                log_exception(e)
+                return False
+
+        metrics.inc("sends")
+        return True
+
+
+class TokenBucket:
+    def __init__(self, rate, per):
+        self.capacity = rate
+        self.tokens = rate
+        self.refill = rate / per
+        self.updated = time.monotonic()
+
+    def take(self):
+        # Consume a token and return 0, or return how long until one is available
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.refill
+        )
+        self.updated = now
+
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+
+        return (1 - self.tokens) / self.refill
+
+    def empty(self):
+        self.tokens = 0
+        self.updated = time.monotonic()
+
+
+class _QueuedSend:
+    __slots__ = ("channel", "content", "kwargs", "futures")
+
+    def __init__(self, channel, content, kwargs):
+        self.channel = channel
+        self.content = content
+        self.kwargs = kwargs
+        self.futures = [asyncio.get_running_loop().create_future()]
+
+    def merge(self, other):
+        # Fold another embed-only send into this one, if both fit in one message
+        if self.content or other.content:
+            return False
+        if set(self.kwargs) - {"embed", "embeds"} or set(other.kwargs) - {
+            "embed",
+            "embeds",
+        }:
+            return False
+
+        embeds = self.embeds() + other.embeds()
+        if len(embeds) > MAX_EMBEDS or sum(len(e) for e in embeds) > MAX_EMBED_CHARS:
+            return False
+
+        self.kwargs = {"embeds": embeds}
+        self.futures += other.futures
+        return True
+
+    def embeds(self):
+        if "embeds" in self.kwargs:
+            return list(self.kwargs["embeds"])
+        return [self.kwargs["embed"]]
+
+    def resolve(self, result):
+        for f in self.futures:
+            if not f.done():
+                f.set_result(result)
+
+
+class _ChannelQueue:
+    def __init__(self, rate, per):
+        self.bucket = TokenBucket(rate, per)
+        # One deque per priority
+        self.items = [collections.deque(), collections.deque()]
+        self.task = None
+
+    def __len__(self):
+        return sum(len(i) for i in self.items)
+
+    def pop(self):
+        for i in self.items:
+            if i:
+                return i.popleft()
+
+
+class QueuedDispatcher:
+    # Queues sends per channel and drains each queue no faster than Discord's
+    # per-channel message limit, so bursts wait in our queue instead of
+    # turning into 429s. Alerts always go ahead of subscription forwards.
+    # Once a channel has `max_backlog` sends waiting, the oldest subscription
+    # forward is dropped to make room. Alerts are never dropped. With the
+    # "merge" policy, waiting subscription forwards are first combined into
+    # single messages of up to 10 embeds.
+
+    def __init__(self, concurrency=5, rate=5, per=5.0, max_backlog=50, policy="merge"):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate = rate
+        self.per = per
+        self.max_backlog = max_backlog
+        self.merge = policy == "merge"
+        self.queues = {}
+        self.pending = 0
+
+    def submit(self, channel, priority, content=None, **kwargs):
+        # Returns a future resolving to whether the message went out
+        item = _QueuedSend(channel, content, kwargs)
+
+        queue = self.queues.get(channel.id)
+        if not queue:
+            queue = self.queues[channel.id] = _ChannelQueue(self.rate, self.per)
+
+        waiting = queue.items[priority]
+        if (
+            self.merge
+            and priority == SUBSCRIPTION
+            and waiting
+            and waiting[-1].merge(item)
+        ):
+            metrics.inc("dispatch_merged")
+            return item.futures[0]
+
+        if len(queue) >= self.max_backlog:
+            if queue.items[SUBSCRIPTION]:
+                queue.items[SUBSCRIPTION].popleft().resolve(False)
+                self.pending -= 1
+                metrics.inc("dispatch_dropped")
+            elif priority == SUBSCRIPTION:
+                item.resolve(False)
+                metrics.inc("dispatch_dropped")
+                return item.futures[0]
+
+        waiting.append(item)
+        self.pending += 1
+
+        if not queue.task:
+            queue.task = asyncio.create_task(self._drain(queue))
+
+        return item.futures[0]
+
+    async def _drain(self, queue):
+        try:
+            while len(queue):
+                delay = queue.bucket.take()
+                if delay:
+                    await asyncio.sleep(delay)
+                    continue
+
+                item = queue.pop()
+                self.pending -= 1
+                try:
+                    item.resolve(await self._send(queue, item))
+                except asyncio.CancelledError:
+                    # Abandoned by close; whoever waits on it must not hang
+                    item.resolve(False)
+                    raise
+        finally:
+            # The queue itself stays around so its bucket remembers recent sends
+            queue.task = None
+
+    async def _send(self, queue, item):
+        async with self.semaphore:
+            try:
+                with metrics.timer("send"):
+                    await item.channel.send(item.content, **item.kwargs)
+            except discord.HTTPException as e:
+                if e.status == 429:
+                    # Our idea of the bucket was off; back off for a full window
+                    queue.bucket.empty()
+                metrics.inc("send_failures")
+                log_exception(e)
+                return False
+            except Exception as e:
+                metrics.inc("send_failures")
+                log_exception(e)
+                return False
+
+        metrics.inc("sends")
+        return True
+
+    async def close(self, timeout=5.0):
+        # Give queued sends a chance to go out, then abandon the rest
+        tasks = [q.task for q in self.queues.values() if q.task]
+        if not tasks:
+            return
+
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for t in pending:
+            t.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        for q in list(self.queues.values()):
+            for i in q.items:
+                while i:
+                    i.popleft().resolve(False)
@@ -0,0 +1,105 @@
+import asyncio
+import heapq
+import sys
+import time
+import traceback
+
+
+class ExpiryScheduler:
+    # Expires keys at wall clock deadlines from a single task sleeping on a heap,
+    # rather than a sleeping task per key. Due keys are handed to `callback` in
+    # batches of up to `batch_size`.
+    #
+    # Replaced and discarded deadlines are left in the heap and skipped when they
+    # come up; `deadlines` is the source of truth.
+
+    def __init__(self, callback, batch_size=500):
+        self.callback = callback
+        self.batch_size = batch_size
+
+        # key -> expires_at
+        self.deadlines = {}
+        # (expires_at, key)
+        self.heap = []
+
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def size(self):
+        return len(self.deadlines)
+
+    def get(self, key):
+        return self.deadlines.get(key)
+
+    def set(self, key, expires_at):
+        if self.deadlines.get(key) == expires_at:
+            return
+
+        self.deadlines[key] = expires_at
+        if not self.heap or expires_at < self.heap[0][0]:
+            self.wakeup.set()
+        heapq.heappush(self.heap, (expires_at, key))
+
+        # Rebuild once stale entries make up most of the heap
+        if len(self.heap) > 2 * len(self.deadlines) + 1024:
+            self.heap = [(e, k) for k, e in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def discard(self, key):
+        self.deadlines.pop(key, None)
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task:
+            task = self.task
+            self.task = None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def _pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            expires_at, key = heapq.heappop(self.heap)
+            if self.deadlines.get(key) == expires_at:
+                del self.deadlines[key]
+                due.append(key)
+        return due
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+
+            delay = None
+            if self.heap:
+                delay = self.heap[0][0] - time.time()
+
+            if delay is None or delay > 0:
+                timer = None
+                if delay is not None:
+                    timer = asyncio.get_running_loop().call_later(
+                        delay, self.wakeup.set
+                    )
+                try:
+                    await self.wakeup.wait()
+                finally:
+                    if timer:
+                        timer.cancel()
+                continue
+
+            due = self._pop_due(time.time())
+            if not due:
+                continue
+
+            try:
+                await self.callback(due)
+            except Exception as e:
+                print(
+                    "".join(traceback.TracebackException.from_exception(e).format()),
+                    file=sys.stderr,
+                )
@@ -0,0 +1,172 @@
+import asyncio
+import sys
+import time
+import traceback
+from collections import deque
+
+from Dispatch import ALERT, SUBSCRIPTION
+from Metrics import metrics
+
+
+class _GuildQueue:
+    __slots__ = ("guild", "items", "alert_users", "busy", "in_ring", "shed")
+
+    def __init__(self, guild):
+        self.guild = guild
+        # Indexed by priority; (message, enqueued_at)
+        self.items = (deque(), deque())
+        # Authors with a queued ALERT item. Only the first sighting can fulfil
+        # their requests, so later ones are queued as subscription work.
+        self.alert_users = set()
+        self.busy = False
+        # Whether the guild is waiting in each of the intake's ready rings
+        self.in_ring = [False, False]
+        # user_id -> forwards shed since the queue was last empty
+        self.shed = {}
+
+    def __len__(self):
+        return len(self.items[ALERT]) + len(self.items[SUBSCRIPTION])
+
+
+class SightingIntake:
+    # Bounded stage between on_message and UserWatch. Sightings are queued per
+    # guild and `workers` tasks take turns across guilds, one sighting per
+    # guild per turn, so a raided guild only ever delays itself. Guilds with a
+    # sighting that can fulfil alerts are served before those with only
+    # subscription work.
+    #
+    # Alert sightings are never shed. Subscription sightings beyond
+    # `max_guild_backlog` for a guild, or `max_backlog` overall, are: with the
+    # "drop" policy the oldest is discarded, and with "summarize" it is also
+    # counted and `on_summary(guild, {user_id: count})` is called once the
+    # guild has caught up.
+
+    def __init__(
+        self,
+        handler,
+        workers=4,
+        max_backlog=5000,
+        max_guild_backlog=200,
+        policy="summarize",
+        on_summary=None,
+    ):
+        self.handler = handler
+        self.workers = workers
+        self.max_backlog = max_backlog
+        self.max_guild_backlog = max_guild_backlog
+        self.summarize = policy == "summarize" and on_summary
+        self.on_summary = on_summary
+
+        # guild_id -> _GuildQueue
+        self.guilds = {}
+        # Guilds with work, by priority. May hold guilds that have since gone
+        # busy or empty; those are skipped when they come up.
+        self.ready = (deque(), deque())
+        self.backlog = 0
+
+        self.wakeup = asyncio.Event()
+        self.tasks = []
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def close(self):
+        tasks = self.tasks
+        self.tasks = []
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.backlog:
+            metrics.inc("intake_abandoned", self.backlog)
+
+    def submit(self, message, alert=False):
+        guild = message.guild
+        queue = self.guilds.get(guild.id)
+        if not queue:
+            queue = self.guilds[guild.id] = _GuildQueue(guild)
+
+        author_id = message.author.id
+        priority = SUBSCRIPTION
+        if alert and author_id not in queue.alert_users:
+            queue.alert_users.add(author_id)
+            priority = ALERT
+
+        waiting = queue.items[SUBSCRIPTION]
+        if priority == SUBSCRIPTION and (
+            len(waiting) >= self.max_guild_backlog or self.backlog >= self.max_backlog
+        ):
+            if not waiting:
+                # Over the global limit with nothing of this guild's to shed
+                self._shed(queue, author_id)
+                return
+            self._shed(queue, waiting.popleft()[0].author.id)
+            self.backlog -= 1
+
+        queue.items[priority].append((message, time.perf_counter()))
+        self.backlog += 1
+        self._ready(queue, priority)
+
+    def _shed(self, queue, user_id):
+        if self.summarize:
+            queue.shed[user_id] = queue.shed.get(user_id, 0) + 1
+            metrics.inc("intake_summarized")
+        else:
+            metrics.inc("intake_dropped")
+
+    def _ready(self, queue, priority):
+        if not queue.in_ring[priority]:
+            queue.in_ring[priority] = True
+            self.ready[priority].append(queue)
+            self.wakeup.set()
+
+    def _next(self):
+        # The next guild to serve and the item to serve it, or None
+        for priority in (ALERT, SUBSCRIPTION):
+            ring = self.ready[priority]
+            while ring:
+                queue = ring.popleft()
+                queue.in_ring[priority] = False
+                if queue.busy or not len(queue):
+                    continue
+
+                queue.busy = True
+                for p in (ALERT, SUBSCRIPTION):
+                    if queue.items[p]:
+                        message, enqueued_at = queue.items[p].popleft()
+                        if p == ALERT:
+                            queue.alert_users.discard(message.author.id)
+                        self.backlog -= 1
+                        return queue, message, enqueued_at
+
+        return None
+
+    async def _run(self):
+        while True:
+            item = self._next()
+            if not item:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            queue, message, enqueued_at = item
+            metrics.observe("intake_wait", time.perf_counter() - enqueued_at)
+            try:
+                await self.handler(message)
+            except Exception as e:
+                print(
+                    "".join(traceback.TracebackException.from_exception(e).format()),
+                    file=sys.stderr,
+                )
+            finally:
+                queue.busy = False
+
+            for p in (ALERT, SUBSCRIPTION):
+                if queue.items[p]:
+                    self._ready(queue, p)
+
+            if not len(queue):
+                self.guilds.pop(queue.guild.id, None)
+                if queue.shed:
+                    self.on_summary(queue.guild, queue.shed)
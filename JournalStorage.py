@@ -0,0 +1,424 @@
+import asyncio
+import itertools
+import json
+import os
+import struct
+import sys
+import traceback
+
+from DBInterface import LOAD_CHUNK_SIZE, TABLE_COLUMNS
+from Metrics import metrics
+
+
+# Storage backend that appends every mutation to a binary journal instead of
+# issuing SQL. The journal is rotated every COMPACT_EVERY records, and rotated
+# journals are folded into a snapshot in a background thread. On startup the
+# snapshot is loaded and the journals after it are replayed.
+#
+# Layout of the directory at `path`:
+#   snapshot          latest compacted state
+#   journal.00000001  journals, replayed in order after the snapshot
+#
+# Every record is a 1 byte opcode followed by its payload. Alert requests and
+# subscriptions are fixed width; guild configs are length-prefixed JSON since
+# their columns grow over time.
+
+SNAPSHOT_MAGIC = b"MWSNAP1\n"
+SNAPSHOT_HEADER = struct.Struct("<Q")  # last journal folded into the snapshot
+
+OP = struct.Struct("<B")
+ALERT_UPSERT = 1
+ALERT_DELETE = 2
+ALERT_DELETE_FULFILLED = 3
+SUBSCRIPTION_INSERT = 4
+SUBSCRIPTION_DELETE = 5
+CONFIG_UPSERT = 6
+ALERT_UPSERT_EXPIRING = 7
+
+# message_id is stored as 0 when there is none
+PAYLOADS = {
+    ALERT_UPSERT: struct.Struct("<QQQQQ"),
+    ALERT_DELETE: struct.Struct("<QQQ"),
+    ALERT_DELETE_FULFILLED: struct.Struct("<QQQQ"),
+    SUBSCRIPTION_INSERT: struct.Struct("<QQ"),
+    SUBSCRIPTION_DELETE: struct.Struct("<QQ"),
+    CONFIG_UPSERT: struct.Struct("<I"),  # followed by that many bytes of JSON
+    ALERT_UPSERT_EXPIRING: struct.Struct("<QQQQQd"),
+}
+
+COMPACT_EVERY = 100000
+
+
+def _encode(op, *values):
+    if op == CONFIG_UPSERT:
+        data = json.dumps(values, separators=(",", ":")).encode()
+        return OP.pack(op) + PAYLOADS[op].pack(len(data)) + data
+    return OP.pack(op) + PAYLOADS[op].pack(*values)
+
+
+def _encode_alert(
+    user_id, guild_id, requester_id, channel_id, message_id, expires_at=None
+):
+    # Requests without an expiry keep the shorter record
+    if expires_at:
+        return _encode(
+            ALERT_UPSERT_EXPIRING,
+            user_id,
+            guild_id,
+            requester_id,
+            channel_id,
+            message_id or 0,
+            expires_at,
+        )
+    return _encode(
+        ALERT_UPSERT, user_id, guild_id, requester_id, channel_id, message_id or 0
+    )
+
+
+def _replay(fp, state):
+    # Applies every complete record in fp to state. Returns the offset of the
+    # end of the last complete record; anything after it is a torn write.
+    # This is the whole cold start, so the dispatch is inlined.
+    alerts, subscriptions, configs = state
+    with open(fp, "rb") as f:
+        data = f.read()
+
+    offset = 0
+    if data.startswith(SNAPSHOT_MAGIC):
+        offset = len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size
+
+    sizes = {op: 1 + payload.size for op, payload in PAYLOADS.items()}
+    unpack = {op: payload.unpack_from for op, payload in PAYLOADS.items()}
+    end = len(data)
+    while offset < end:
+        op = data[offset]
+        size = sizes.get(op)
+        if not size or offset + size > end:
+            break
+        values = unpack[op](data, offset + 1)
+
+        if op == ALERT_UPSERT or op == ALERT_UPSERT_EXPIRING:
+            # (channel_id, message_id) or (channel_id, message_id, expires_at)
+            alerts[values[:3]] = values[3:]
+        elif op == ALERT_DELETE:
+            alerts.pop(values, None)
+        elif op == ALERT_DELETE_FULFILLED:
+            key = values[:3]
+            current = alerts.get(key)
+            if current and current[1] == values[3]:
+                del alerts[key]
+        elif op == SUBSCRIPTION_INSERT:
+            subscriptions.add(values)
+        elif op == SUBSCRIPTION_DELETE:
+            subscriptions.discard(values)
+        elif op == CONFIG_UPSERT:
+            start = offset + size
+            size += values[0]
+            if offset + size > end:
+                break
+            try:
+                row = json.loads(data[start : offset + size])
+            except ValueError:
+                break
+            configs[row[0]] = tuple(row)
+
+        offset += size
+    return offset
+
+
+def _snapshot_journal(fp):
+    # Index of the last journal already folded into the snapshot at fp
+    with open(fp, "rb") as f:
+        header = f.read(len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size)
+    if (
+        not header.startswith(SNAPSHOT_MAGIC)
+        or len(header) < len(SNAPSHOT_MAGIC) + SNAPSHOT_HEADER.size
+    ):
+        return 0
+    return SNAPSHOT_HEADER.unpack_from(header, len(SNAPSHOT_MAGIC))[0]
+
+
+def _write_snapshot(fp, state, last_journal):
+    alerts, subscriptions, configs = state
+    tmp = fp + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(SNAPSHOT_MAGIC + SNAPSHOT_HEADER.pack(last_journal))
+        records = itertools.chain(
+            (_encode_alert(*k, *v) for k, v in alerts.items()),
+            (_encode(SUBSCRIPTION_INSERT, *k) for k in subscriptions),
+            (_encode(CONFIG_UPSERT, *row) for row in configs.values()),
+        )
+        while True:
+            chunk = b"".join(itertools.islice(records, LOAD_CHUNK_SIZE))
+            if not chunk:
+                break
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, fp)
+
+
+class JournalStorage:
+    def __init__(self, path, compact_every=COMPACT_EVERY, fsync=False):
+        self.path = path
+        self.compact_every = compact_every
+        # Without fsync, writes survive process crashes but not power loss,
+        # the same tradeoff as synchronous=NORMAL on the SQLite backend
+        self.fsync = fsync
+
+        self.journal = None
+        self.journal_index = 0
+        self.records = 0
+        self.compaction = None
+
+        # State read on startup, handed out once by iter_table
+        self.loaded = None
+
+    def _snapshot_fp(self):
+        return os.path.join(self.path, "snapshot")
+
+    def _journal_fp(self, index):
+        return os.path.join(self.path, f"journal.{index:08d}")
+
+    def _journals(self):
+        journals = []
+        for name in os.listdir(self.path):
+            if name.startswith("journal."):
+                try:
+                    journals.append(int(name[len("journal.") :]))
+                except ValueError:
+                    pass
+        return sorted(journals)
+
+    async def connect(self):
+        os.makedirs(self.path, exist_ok=True)
+
+    async def close(self):
+        if self.compaction:
+            await self.compaction
+        if not self.journal:
+            return
+
+        journal = self.journal
+        self.journal = None
+        journal.flush()
+        await asyncio.to_thread(os.fsync, journal.fileno())
+        journal.close()
+
+    def _load(self):
+        state = ({}, set(), {})
+        folded = 0
+        if os.path.exists(self._snapshot_fp()):
+            folded = _snapshot_journal(self._snapshot_fp())
+            _replay(self._snapshot_fp(), state)
+
+        journals = []
+        for index in self._journals():
+            if index <= folded:
+                # Left behind by a compaction interrupted after its snapshot
+                # was written
+                os.remove(self._journal_fp(index))
+                continue
+            journals.append(index)
+            fp = self._journal_fp(index)
+            end = _replay(fp, state)
+            if end < os.path.getsize(fp):
+                # Torn tail from a crash mid-write; drop it so appends after it
+                # are readable
+                print(f"Truncating {os.path.getsize(fp) - end} bytes from {fp}")
+                os.truncate(fp, end)
+
+        return state, folded, max(journals + [folded])
+
+    @metrics.timed("db_initialize_database")
+    async def initialize_database(self):
+        await self.connect()
+        self.loaded, folded, last = await asyncio.to_thread(self._load)
+
+        # Start a fresh journal rather than appending to the one replayed
+        self.journal_index = last + 1
+        self.journal = open(self._journal_fp(self.journal_index), "ab")
+        self.records = 0
+
+        # Fold whatever was replayed into the snapshot so the next start is a
+        # single sequential read
+        if last > folded:
+            self.compaction = asyncio.create_task(self._compact(last))
+
+    async def iter_table(self, table, shard_count=None, shard_ids=None):
+        # Same contract as DBInterface.iter_table, including its TABLE_ORDER.
+        # Each table is only read once on startup, so its loaded state is
+        # released as soon as it is handed out.
+        alerts, subscriptions, configs = self.loaded
+        guild_index = 1
+        if table == "alert_requests":
+            rows = (
+                k + (v[0], v[1] or None, v[2] if len(v) > 2 else None)
+                for k, v in sorted(alerts.items())
+            )
+            alerts = {}
+        elif table == "subscriptions":
+            rows = iter(sorted(subscriptions))
+            subscriptions = set()
+        else:
+            width = len(TABLE_COLUMNS[table])
+            # Pad rows written before columns were added
+            rows = (r + (None,) * (width - len(r)) for r in configs.values())
+            configs = {}
+            guild_index = 0
+        self.loaded = (alerts, subscriptions, configs)
+
+        if shard_ids is not None:
+            shard_ids = set(shard_ids)
+            rows = (
+                r for r in rows if (r[guild_index] >> 22) % shard_count in shard_ids
+            )
+
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= LOAD_CHUNK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _append(self, records):
+        self.journal.write(b"".join(records))
+        self.journal.flush()
+        if self.fsync:
+            os.fsync(self.journal.fileno())
+
+        self.records += len(records)
+        if self.records >= self.compact_every and not self.compaction:
+            self._rotate()
+
+    def _rotate(self):
+        # New writes go to a fresh journal while the finished ones are folded
+        # into the snapshot off the event loop
+        self.journal.close()
+        folded = self.journal_index
+        self.journal_index += 1
+        self.journal = open(self._journal_fp(self.journal_index), "ab")
+        self.records = 0
+
+        self.compaction = asyncio.create_task(self._compact(folded))
+
+    def _fold(self, folded):
+        state = ({}, set(), {})
+        previous = 0
+        if os.path.exists(self._snapshot_fp()):
+            previous = _snapshot_journal(self._snapshot_fp())
+            _replay(self._snapshot_fp(), state)
+
+        journals = [i for i in self._journals() if previous < i <= folded]
+        for index in journals:
+            _replay(self._journal_fp(index), state)
+
+        _write_snapshot(self._snapshot_fp(), state, folded)
+        for index in journals:
+            os.remove(self._journal_fp(index))
+
+    async def _compact(self, folded):
+        try:
+            with metrics.timer("db_compaction"):
+                await asyncio.to_thread(self._fold, folded)
+        except:
+            # The journals are left in place, so nothing is lost; the next
+            # rotation retries
+            print("Journal compaction failed", file=sys.stderr)
+            traceback.print_exc()
+        finally:
+            self.compaction = None
+
+    @metrics.timed("db_insert_alert_request")
+    async def insert_alert_request(
+        self, user_id, guild_id, requester_id, channel_id, message_id, expires_at=None
+    ):
+        self._append(
+            [
+                _encode_alert(
+                    user_id, guild_id, requester_id, channel_id, message_id, expires_at
+                )
+            ]
+        )
+
+    @metrics.timed("db_upsert_alert_requests")
+    async def upsert_alert_requests(self, rows):
+        records = [_encode_alert(*row) for row in rows]
+        if records:
+            self._append(records)
+
+    @metrics.timed("db_update_alert_request")
+    async def update_alert_request(
+        self, user_id, guild_id, requester_id, channel_id, message_id, expires_at=None
+    ):
+        # Only ever called for requests that exist, so this is an upsert
+        self._append(
+            [
+                _encode_alert(
+                    user_id, guild_id, requester_id, channel_id, message_id, expires_at
+                )
+            ]
+        )
+
+    @metrics.timed("db_remove_alert_request")
+    async def remove_alert_request(self, user_id, guild_id, requester_id):
+        self._append([_encode(ALERT_DELETE, user_id, guild_id, requester_id)])
+
+    @metrics.timed("db_remove_alert_requests")
+    async def remove_alert_requests(self, keys):
+        records = [_encode(ALERT_DELETE, *k) for k in keys]
+        if records:
+            self._append(records)
+
+    @metrics.timed("db_remove_fulfilled_alert_requests")
+    async def remove_fulfilled_alert_requests(self, rows):
+        records = [
+            _encode(ALERT_DELETE_FULFILLED, u, g, r, m or 0) for u, g, r, m in rows
+        ]
+        if records:
+            self._append(records)
+
+    @metrics.timed("db_insert_subscription")
+    async def insert_subscription(self, user_id, guild_id):
+        self._append([_encode(SUBSCRIPTION_INSERT, user_id, guild_id)])
+
+    @metrics.timed("db_insert_subscriptions")
+    async def insert_subscriptions(self, keys):
+        records = [_encode(SUBSCRIPTION_INSERT, *k) for k in keys]
+        if records:
+            self._append(records)
+
+    @metrics.timed("db_remove_subscription")
+    async def remove_subscription(self, user_id, guild_id):
+        self._append([_encode(SUBSCRIPTION_DELETE, user_id, guild_id)])
+
+    @metrics.timed("db_remove_subscriptions")
+    async def remove_subscriptions(self, keys):
+        records = [_encode(SUBSCRIPTION_DELETE, *k) for k in keys]
+        if records:
+            self._append(records)
+
+    @metrics.timed("db_upsert_guild_subscription_config")
+    async def upsert_guild_subscription_config(self, *row):
+        self._append([_encode(CONFIG_UPSERT, *row)])
+
+    @metrics.timed("db_apply_batch")
+    async def apply_batch(
+        self,
+        alert_upserts=(),
+        alert_deletes=(),
+        subscription_inserts=(),
+        subscription_deletes=(),
+        config_upserts=(),
+    ):
+        # Written with a single write call, so a batch lands whole or is cut
+        # off at a record boundary that replay can recover from
+        records = [_encode_alert(*row) for row in alert_upserts]
+        records.extend(_encode(ALERT_DELETE, *k) for k in alert_deletes)
+        records.extend(_encode(SUBSCRIPTION_INSERT, *k) for k in subscription_inserts)
+        records.extend(_encode(SUBSCRIPTION_DELETE, *k) for k in subscription_deletes)
+        records.extend(_encode(CONFIG_UPSERT, *row) for row in config_upserts)
+        if records:
+            self._append(records)
@@ -0,0 +1,204 @@
+import asyncio
+import functools
+import time
+
+# Latency histogram bucket upper bounds, in seconds
+BUCKETS = (
+    0.00001,
+    0.00005,
+    0.0001,
+    0.0005,
+    0.001,
+    0.005,
+    0.01,
+    0.05,
+    0.1,
+    0.5,
+    1.0,
+    5.0,
+)
+
+PREFIX = "memberwatch_"
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, b in enumerate(BUCKETS):
+            if value <= b:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        target = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target and c:
+                return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+        return 0.0
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "started")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.started)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    # Counters, latency histograms and gauges. Everything is a no-op until
+    # `enabled` is set, so call sites only pay for an attribute check.
+
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.histograms = {}
+        # name -> zero-argument callable, read at render time
+        self.gauges = {}
+        self.server = None
+
+    def inc(self, name, value=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+
+        h = self.histograms.get(name)
+        if not h:
+            h = self.histograms[name] = Histogram()
+        h.observe(seconds)
+
+    def timer(self, name):
+        if not self.enabled:
+            return NULL_TIMER
+        return _Timer(self, name)
+
+    def timed(self, name):
+        # Decorator recording the latency of each call to a coroutine function
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return await func(*args, **kwargs)
+
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started)
+
+            return wrapper
+
+        return decorator
+
+    def gauge(self, name, func):
+        self.gauges[name] = func
+
+    def read_gauges(self):
+        return {name: func() for name, func in sorted(self.gauges.items())}
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {PREFIX}{name}_total counter")
+            lines.append(f"{PREFIX}{name}_total {value}")
+
+        for name, value in self.read_gauges().items():
+            lines.append(f"# TYPE {PREFIX}{name} gauge")
+            lines.append(f"{PREFIX}{name} {value}")
+
+        for name, h in sorted(self.histograms.items()):
+            metric = f"{PREFIX}{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for b, c in zip(BUCKETS, h.counts):
+                cumulative += c
+                lines.append(f'{metric}_bucket{{le="{b}"}} {cumulative}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {h.count}')
+            lines.append(f"{metric}_sum {h.sum}")
+            lines.append(f"{metric}_count {h.count}")
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        # Short human-readable report for the stats command
+        lines = [f"{name}: {value}" for name, value in self.read_gauges().items()]
+
+        if not self.enabled:
+            lines.append("Metrics collection is disabled.")
+            return "\n".join(lines)
+
+        lines += [f"{name}: {value}" for name, value in sorted(self.counters.items())]
+        for name, h in sorted(self.histograms.items()):
+            if h.count:
+                lines.append(
+                    f"{name}: n={h.count} avg={h.sum / h.count * 1000:.2f}ms p50<={h.quantile(0.5) * 1000:g}ms p99<={h.quantile(0.99) * 1000:g}ms"
+                )
+
+        return "\n".join(lines)
+
+    async def serve(self, host="127.0.0.1", port=9100):
+        # Minimal HTTP endpoint answering every request with render()
+        async def handle(reader, writer):
+            try:
+                await reader.readuntil(b"\r\n\r\n")
+            except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                pass
+
+            body = self.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            try:
+                await writer.drain()
+            finally:
+                writer.close()
+
+        self.server = await asyncio.start_server(handle, host, port)
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+metrics = Metrics()
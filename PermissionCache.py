@@ -0,0 +1,53 @@
+class PermissionCache:
+    # Memoizes channel.permissions_for(member). Entries are dropped by the
+    # invalidate_* methods, which bot.py calls from the gateway events that can
+    # change a member's effective permissions.
+
+    def __init__(self):
+        # guild_id -> channel_id -> member_id -> Permissions
+        self.guilds = {}
+        # Entries across all of them, so size() needn't walk the cache
+        self.entries = 0
+
+    def permissions_for(self, channel, member):
+        channels = self.guilds.get(channel.guild.id)
+        if channels is None:
+            channels = self.guilds[channel.guild.id] = {}
+
+        members = channels.get(channel.id)
+        if members is None:
+            members = channels[channel.id] = {}
+
+        permissions = members.get(member.id)
+        if permissions is None:
+            permissions = members[member.id] = channel.permissions_for(member)
+            self.entries += 1
+
+        return permissions
+
+    def invalidate_guild(self, guild_id):
+        # Role changes, ownership transfers and leaving the guild
+        channels = self.guilds.pop(guild_id, None)
+        if channels:
+            self.entries -= sum(len(members) for members in channels.values())
+
+    def invalidate_channel(self, channel):
+        # Overwrite changes, category syncs and deletions
+        channels = self.guilds.get(channel.guild.id)
+        if channels:
+            members = channels.pop(channel.id, None)
+            if members:
+                self.entries -= len(members)
+
+    def invalidate_member(self, guild_id, member_id):
+        # Role assignments, timeouts and departures
+        channels = self.guilds.get(guild_id)
+        if not channels:
+            return
+
+        for members in channels.values():
+            if members.pop(member_id, None) is not None:
+                self.entries -= 1
+
+    def size(self):
+        return self.entries
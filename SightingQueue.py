@@ -0,0 +1,220 @@
+import datetime
+import json
+
+import aiosqlite
+import disnake as discord
+
+import util
+
+# A local SQLite-backed queue of sighting records. In split mode the gateway
+# process resolves each sighting's destinations, pushes a compact record here
+# and moves on; worker.py processes claim records, render the embeds, send
+# them and delete the fulfilled alert requests.
+#
+# Requests whose alert failed to send are pushed back through the restored
+# table, for the gateway to put back in its watch state.
+
+
+class SightingQueue:
+    def __init__(self, fp):
+        self.fp = fp
+        self.conn = None
+
+    async def connect(self):
+        if self.conn:
+            return self.conn
+
+        # Autocommit, so claim can take the write lock up front
+        self.conn = await aiosqlite.connect(self.fp, isolation_level=None)
+        await self.conn.execute("PRAGMA journal_mode=WAL;")
+        await self.conn.execute("PRAGMA synchronous=NORMAL;")
+        await self.conn.execute("PRAGMA busy_timeout=5000;")
+        await self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sightings(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                payload TEXT
+            );
+            """
+        )
+        await self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS restored(
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                guild_id INTEGER,
+                requester_id INTEGER,
+                channel_id INTEGER,
+                message_id INTEGER,
+                expires_at REAL
+            );
+            """
+        )
+        return self.conn
+
+    async def close(self):
+        if not self.conn:
+            return
+
+        conn = self.conn
+        self.conn = None
+        await conn.close()
+
+    async def push(self, record):
+        await self.conn.execute(
+            "INSERT INTO sightings(payload) VALUES (?);",
+            (json.dumps(record, separators=(",", ":")),),
+        )
+
+    async def claim(self, limit=100):
+        # Removes and returns up to `limit` of the oldest records. Each record
+        # goes to exactly one worker; one that dies mid-batch loses it.
+        await self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            async with self.conn.execute(
+                "SELECT id, payload FROM sightings ORDER BY id LIMIT ?;", (limit,)
+            ) as cursor:
+                rows = await cursor.fetchall()
+
+            if rows:
+                await self.conn.execute(
+                    "DELETE FROM sightings WHERE id <= ?;", (rows[-1][0],)
+                )
+            await self.conn.execute("COMMIT;")
+        except:
+            await self.conn.execute("ROLLBACK;")
+            raise
+
+        return [json.loads(p) for _, p in rows]
+
+    async def push_restored(self, rows):
+        # rows: (user_id, guild_id, requester_id, channel_id, message_id, expires_at)
+        await self.conn.executemany(
+            """
+            INSERT INTO restored(
+                user_id, guild_id, requester_id, channel_id, message_id, expires_at
+            ) VALUES (?, ?, ?, ?, ?, ?);
+            """,
+            rows,
+        )
+
+    async def claim_restored(self, limit=500, shard_count=None, shard_ids=None):
+        # Removes and returns up to `limit` restored alert requests as
+        # push_restored rows. If shard_ids is given, only those for guilds on
+        # these shards are taken and the rest are left for their gateway.
+        where = ""
+        params = ()
+        if shard_ids is not None:
+            where = (
+                f"WHERE ((guild_id >> 22) % ?) IN ({', '.join('?' * len(shard_ids))})"
+            )
+            params = (shard_count, *shard_ids)
+
+        await self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            async with self.conn.execute(
+                f"""
+                SELECT
+                    id, user_id, guild_id, requester_id, channel_id, message_id, expires_at
+                FROM
+                    restored
+                {where}
+                ORDER BY id
+                LIMIT ?;
+                """,
+                (*params, limit),
+            ) as cursor:
+                rows = await cursor.fetchall()
+
+            if rows:
+                await self.conn.executemany(
+                    "DELETE FROM restored WHERE id = ?;", [(r[0],) for r in rows]
+                )
+            await self.conn.execute("COMMIT;")
+        except:
+            await self.conn.execute("ROLLBACK;")
+            raise
+
+        return [r[1:] for r in rows]
+
+    async def size(self):
+        async with self.conn.execute("SELECT COUNT(*) FROM sightings;") as cursor:
+            return (await cursor.fetchone())[0]
+
+
+def encode_sighting(message, subscription, alerts, fulfilled):
+    # subscription: (channel_id, digest_window, digest_size) or None
+    # alerts: [(channel_id, requester_ids, message_ids)]
+    # fulfilled: {requester_id: (channel_id, message_id, expires_at)} removed by
+    # this sighting
+    author = message.author
+    avatar = author.display_avatar
+    _, avatar_url = util.author_header(author)
+
+    return {
+        "g": message.guild.id,
+        "u": author.id,
+        "m": {
+            "i": message.id,
+            "c": message.content,
+            "j": message.jump_url,
+            "t": message.created_at.isoformat(),
+            "n": message.channel.name,
+            "a": [
+                author.id,
+                author.name,
+                author.discriminator,
+                avatar.key,
+                avatar_url,
+                getattr(author.color, "value", author.color),
+            ],
+            "e": [e.to_dict() for e in message.embeds if e.type == "rich"],
+            "f": [a.url for a in message.attachments],
+        },
+        "s": list(subscription) if subscription else None,
+        "a": [[c, list(r), list(m)] for c, r, m in alerts],
+        "r": [[r, m, e] for r, (_, m, e) in fulfilled.items()],
+    }
+
+
+# Just enough of disnake's Message/Member/Asset for util.build_message_embed
+
+
+class _RecordAsset:
+    def __init__(self, key, url):
+        self.key = key
+        self.url = url
+
+    def replace(self, **kwargs):
+        return self
+
+
+class _RecordAuthor:
+    def __init__(self, user_id, name, discriminator, avatar_key, avatar_url, color):
+        self.id = user_id
+        self.name = name
+        self.discriminator = discriminator
+        self.display_avatar = _RecordAsset(avatar_key, avatar_url)
+        self.color = color
+
+
+class _RecordChannel:
+    def __init__(self, name):
+        self.name = name
+
+
+class _RecordAttachment:
+    def __init__(self, url):
+        self.url = url
+
+
+class RecordMessage:
+    def __init__(self, data):
+        self.id = data["i"]
+        self.content = data["c"]
+        self.jump_url = data["j"]
+        self.created_at = datetime.datetime.fromisoformat(data["t"])
+        self.channel = _RecordChannel(data["n"])
+        self.author = _RecordAuthor(*data["a"])
+        self.embeds = [discord.Embed.from_dict(e) for e in data["e"]]
+        self.attachments = [_RecordAttachment(u) for u in data["f"]]
@@ -0,0 +1,170 @@
+import contextvars
+import functools
+import gzip
+import inspect
+import json
+import time
+
+# Records the traffic reaching UserWatch so replay.py can feed it back offline.
+# A trace is JSON lines, gzipped if the path ends in .gz. The first line is a
+# header, and every other line is one of
+#
+#   ["m", t, guild_id, channel_id, author_id, message_id, embeds, attachments]
+#   ["c", t, method, args]
+#   ["i", t, method, args]
+#
+# where t is seconds since the header's "started". "m" is a guild message,
+# with only counts of rich embeds and attachments. "c" is a call to one of
+# TRACED_CALLS, and "i" is a call reproducing the watch state that was loaded
+# when recording began. No message content or webhook tokens are recorded.
+
+TRACE_VERSION = 1
+
+# UserWatch methods that change watch state. Their arguments are all IDs,
+# numbers or lists of them.
+TRACED_CALLS = (
+    "add_alert_request",
+    "add_alert_requests",
+    "remove_alert_request",
+    "remove_alert_requests",
+    "clear_alert_requests",
+    "add_subscription",
+    "add_subscriptions",
+    "remove_subscription",
+    "remove_subscriptions",
+    "set_guild_subscription_channel",
+    "set_guild_alert_ttl",
+    "purge_guild",
+    "purge_requester",
+    "purge_channel",
+)
+
+# Set while a traced call runs, so the calls it makes itself are not recorded
+_in_call = contextvars.ContextVar("in_traced_call", default=False)
+
+
+def _open(fp, mode):
+    if fp.endswith(".gz"):
+        return gzip.open(fp, mode + "t", encoding="utf-8")
+    return open(fp, mode, encoding="utf-8")
+
+
+def _listify(value):
+    # Key collections and generators as JSON-friendly lists of lists
+    if isinstance(value, (str, bytes)) or not hasattr(value, "__iter__"):
+        return value
+    return [list(v) if isinstance(v, tuple) else v for v in value]
+
+
+def read_trace(fp):
+    # Yields the header dict, then each record as a list
+    with _open(fp, "r") as f:
+        header = json.loads(f.readline())
+        if header.get("version") != TRACE_VERSION:
+            raise ValueError(f"Unsupported trace version {header.get('version')}")
+        yield header
+
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+class TraceRecorder:
+    def __init__(self, fp):
+        self.fp = fp
+        self.started = time.time()
+        self.file = _open(fp, "w")
+        self.records = 0
+        self._write({"version": TRACE_VERSION, "started": self.started})
+
+    def _write(self, record):
+        if not self.file:
+            return
+        self.file.write(json.dumps(record, separators=(",", ":")))
+        self.file.write("\n")
+
+    def _now(self):
+        return round(time.time() - self.started, 3)
+
+    def attach(self, userwatch):
+        # Records the state userwatch has loaded, then every traced call made
+        # on it from here on
+        t = self._now()
+        store = userwatch.store
+        for guild_id in list(store.guild_alerts):
+            for u, r, c, m in store.guild_alert_requests(guild_id):
+                expires_at = userwatch.expiry.get((u, guild_id, r))
+                self._write(
+                    ["i", t, "add_alert_request", [u, guild_id, r, c, m, expires_at]]
+                )
+        for guild_id in list(store.guild_subscription_users):
+            users = list(store.guild_subscriptions(guild_id))
+            self._write(["i", t, "add_subscriptions", [users, guild_id]])
+        for config in list(userwatch.guild_configs.values()):
+            if config.subscription_channel_id:
+                self._write(
+                    [
+                        "i",
+                        t,
+                        "set_guild_subscription_channel",
+                        [
+                            config.guild_id,
+                            config.subscription_channel_id,
+                            config.digest_window,
+                            config.digest_size,
+                        ],
+                    ]
+                )
+            if config.alert_ttl:
+                self._write(
+                    ["i", t, "set_guild_alert_ttl", [config.guild_id, config.alert_ttl]]
+                )
+
+        for name in TRACED_CALLS:
+            setattr(userwatch, name, self._wrap(name, getattr(userwatch, name)))
+
+    def _wrap(self, name, method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        async def traced(*args, **kwargs):
+            if _in_call.get():
+                return await method(*args, **kwargs)
+
+            # Recorded positionally, with generators read out once for both
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            args = [_listify(a) for a in bound.args]
+            self._write(["c", self._now(), name, args])
+            self.records += 1
+
+            token = _in_call.set(True)
+            try:
+                return await method(*args)
+            finally:
+                _in_call.reset(token)
+
+        return traced
+
+    def message(self, message):
+        if message.guild is None or message.author.bot:
+            return
+
+        self._write(
+            [
+                "m",
+                self._now(),
+                message.guild.id,
+                message.channel.id,
+                message.author.id,
+                message.id,
+                sum(1 for e in message.embeds if e.type == "rich"),
+                len(message.attachments),
+            ]
+        )
+        self.records += 1
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
@@ -1,183 +1,859 @@
+import asyncio
+import sys
+import time
+import traceback
+
+import disnake as discord
+
 import util
+from Dispatch import SUBSCRIPTION, DirectDispatcher, QueuedDispatcher, deliver
 from DBInterface import DBInterface
-from models import OperationStatus, CommandResponse
+from Digest import DigestBuffer
+from Expiry import ExpiryScheduler
+from Intake import SightingIntake
+from JournalStorage import JournalStorage
+from Metrics import metrics
+from PermissionCache import PermissionCache
+from SightingQueue import SightingQueue, encode_sighting
+from WatchStore import WatchStore, CompactWatchStore
+from Webhooks import SubscriptionWebhooks, WebhookChannel
+from WriteBehind import WriteBehindQueue
+from models import OperationStatus, CommandResponse, GuildSubscriptionConfig
 
 
-class UserWatch:
-    def __init__(self, db_fp):
-        self.db = DBInterface(db_fp)
-        self.alert_requests = {}
-        self.subscriptions = set()
-        self.guild_subscription_channels = {}
+# Seconds before an expiry that landed on an in-flight claim is checked again
+CLAIM_EXPIRY_RETRY = 60
 
-    async def initialize(self):
-        watch_data = await self.db.initialize_database()
+# Seconds between checks for alert requests restored by split mode workers
+RESTORE_POLL_INTERVAL = 1.0
 
-        alerts_initialized = 0
 
-        for a in watch_data["alert_requests"]:
+class UserWatch:
+    def __init__(
+        self,
+        db_fp,
+        write_behind=None,
+        send_concurrency=5,
+        compact_state=False,
+        dispatcher=None,
+        sighting_queue=None,
+        storage=None,
+        webhooks=None,
+        intake=None,
+    ):
+        self.db = DBInterface(db_fp)
+        if storage and storage.get("BACKEND") == "journal":
+            if sighting_queue:
+                raise ValueError("Split mode needs the sqlite storage backend")
+            self.db = JournalStorage(
+                storage.get("PATH", "journal"),
+                compact_every=storage.get("COMPACT_EVERY", 100000),
+                fsync=storage.get("FSYNC", False),
+            )
 
-            self._add_alert_request(
-                a.user_id, a.guild_id, a.requester_id, a.channel_id, a.message_id
+        # In split mode, sightings are resolved here and pushed to this queue
+        # for worker.py processes to render, send and clean up
+        self.sighting_queue = None
+        self.restore_task = None
+        if sighting_queue:
+            self.sighting_queue = SightingQueue(sighting_queue)
+
+        self.dispatcher = DirectDispatcher(send_concurrency)
+        if dispatcher is not None:
+            self.dispatcher = QueuedDispatcher(
+                send_concurrency,
+                rate=dispatcher.get("CHANNEL_RATE", 5),
+                per=dispatcher.get("CHANNEL_PER", 5.0),
+                max_backlog=dispatcher.get("MAX_BACKLOG", 50),
+                policy=dispatcher.get("POLICY", "merge"),
             )
 
-            alerts_initialized += 1
+        # Mutations go through self.writer, which is either the database itself
+        # or a write-behind queue in front of it
+        self.writer = self.db
+        self.write_behind = None
+        if write_behind:
+            self.write_behind = WriteBehindQueue(
+                self.db,
+                interval=write_behind.get("INTERVAL", 1.0),
+                max_pending=write_behind.get("MAX_PENDING", 500),
+            )
+            self.writer = self.write_behind
+
+        self.store = CompactWatchStore() if compact_state else WatchStore()
+        self.digests = DigestBuffer(self.dispatcher)
+
+        # Subscription forwards can go through a webhook per subscription
+        # channel, queued apart from the bot's own messages. Webhook requests
+        # carry up to 10 embeds, so waiting forwards are always merged.
+        self.webhooks = None
+        self.webhook_dispatcher = None
+        self.webhook_digests = None
+        if webhooks is not None:
+            if sighting_queue:
+                raise ValueError("Split mode does not support subscription webhooks")
+            self.webhooks = SubscriptionWebhooks(self._webhook_lost)
+            self.webhook_dispatcher = QueuedDispatcher(
+                webhooks.get("CONCURRENCY", send_concurrency),
+                rate=webhooks.get("RATE", 5),
+                per=webhooks.get("PER", 2.0),
+                max_backlog=webhooks.get("MAX_BACKLOG", 50),
+                policy="merge",
+            )
+            self.webhook_digests = DigestBuffer(self.webhook_dispatcher)
+        self.permissions = PermissionCache()
+
+        # (user_id, guild_id, requester_id) of alert requests that expire
+        self.expiry = ExpiryScheduler(self._expire_alert_requests)
+
+        # Background tasks settling claimed alert requests once their sends finish
+        self.settling = set()
+        # (user_id, guild_id, requester_id) claimed by those tasks. Their rows
+        # are still in the database until the claim settles.
+        self.claimed = set()
+
+        # Optional bounded, per-guild fair stage in front of handle_user_sighting
+        self.intake = None
+        if intake is not None:
+            self.intake = SightingIntake(
+                self._handle_intake,
+                workers=intake.get("WORKERS", 4),
+                max_backlog=intake.get("MAX_BACKLOG", 5000),
+                max_guild_backlog=intake.get("MAX_GUILD_BACKLOG", 200),
+                policy=intake.get("POLICY", "summarize"),
+                on_summary=self._summarize_shed,
+            )
 
-        self.subscriptions = set(
-            (s.user_id, s.guild_id) for s in watch_data["subscriptions"]
+        # guild_id -> GuildSubscriptionConfig
+        self.guild_configs = {}
+
+        # Shared with the store, so on_message can check it without a call
+        self.watched_users = self.store.watched_users
+
+        metrics.gauge("watched_users", lambda: len(self.watched_users))
+        metrics.gauge("watched_pairs", lambda: len(self.store.alert_requests))
+        metrics.gauge("alert_requests", self.store.alert_request_count)
+        metrics.gauge("subscriptions", self.store.subscription_count)
+        metrics.gauge("pending_sends", lambda: self.dispatcher.pending)
+        metrics.gauge("pending_digest_messages", self.digests.pending)
+        metrics.gauge(
+            "pending_webhook_sends",
+            lambda: self.webhook_dispatcher.pending if self.webhooks else 0,
         )
-        subscriptions_initialized = len(self.subscriptions)
-
-        self.guild_subscription_channels = dict(
-            [
-                (c.guild_id, c.subscription_channel_id)
-                for c in watch_data["guild_subscription_configs"]
-            ]
+        metrics.gauge("cached_permissions", self.permissions.size)
+        metrics.gauge(
+            "intake_backlog", lambda: self.intake.backlog if self.intake else 0
         )
-        configs_initialized = len(self.guild_subscription_channels)
+        metrics.gauge("expiring_alert_requests", self.expiry.size)
+        metrics.gauge(
+            "pending_writes",
+            lambda: self.write_behind.pending() if self.write_behind else 0,
+        )
+
+        # Set on initialize when running on a subset of shards
+        self.shard_count = None
+        self.shard_ids = None
+
+    async def initialize(self, shard_count=None, shard_ids=None):
+        self.shard_count = shard_count
+        self.shard_ids = shard_ids
+
+        await self.db.initialize_database()
+        started = time.perf_counter()
+
+        # shard_id -> [alert requests, subscriptions, guild configs]
+        shard_counts = {}
+
+        def count(guild_id, i):
+            s = util.shard_id(guild_id, shard_count)
+            if not s in shard_counts:
+                shard_counts[s] = [0, 0, 0]
+            shard_counts[s][i] += 1
+
+        # Rows are streamed off the cursor straight into the indexes
+        alerts_initialized = 0
+        async for rows in self.db.iter_table("alert_requests", shard_count, shard_ids):
+            for row in rows:
+                self._add_alert_request(*row)
+                count(row[1], 0)
+            alerts_initialized += len(rows)
+        alerts_loaded = time.perf_counter()
+
+        subscriptions_initialized = 0
+        async for rows in self.db.iter_table("subscriptions", shard_count, shard_ids):
+            for user_id, guild_id in rows:
+                self.store.add_subscription(user_id, guild_id)
+                count(guild_id, 1)
+            subscriptions_initialized += len(rows)
+        subscriptions_loaded = time.perf_counter()
+
+        configs_initialized = 0
+        async for rows in self.db.iter_table(
+            "guild_subscription_configs", shard_count, shard_ids
+        ):
+            for row in rows:
+                self.guild_configs[row[0]] = GuildSubscriptionConfig(*row)
+                count(row[0], 2)
+            configs_initialized += len(rows)
+        configs_loaded = time.perf_counter()
+
+        if self.write_behind:
+            self.write_behind.start()
+
+        # Anything that expired while we were down goes in the first batch
+        self.expiry.start()
+
+        if self.intake:
+            self.intake.start()
+
+        if self.sighting_queue:
+            await self.sighting_queue.connect()
+            self.restore_task = asyncio.create_task(self._poll_restored())
 
         print(
             f"Successfully initialized {alerts_initialized} alert requests, {subscriptions_initialized} subscriptions and {configs_initialized} guild configs."
         )
+        print(
+            f"  Watch state is using about {self.store.memory_usage() / 1024:.0f} KiB."
+        )
+        print(
+            f"  Loaded alert requests in {alerts_loaded - started:.3f}s, subscriptions in {subscriptions_loaded - alerts_loaded:.3f}s and guild configs in {configs_loaded - subscriptions_loaded:.3f}s."
+        )
+        if shard_count:
+            for s in sorted(shard_counts):
+                a, b, c = shard_counts[s]
+                print(
+                    f"  Shard {s}/{shard_count}: {a} alert requests, {b} subscriptions and {c} guild configs."
+                )
+
+    async def flush(self):
+        if self.write_behind:
+            await self.write_behind.flush()
+
+    async def close(self):
+        if self.intake:
+            await self.intake.close()
+        await self.expiry.close()
+        self.digests.flush_all()
+        await self.dispatcher.close()
+        if self.webhooks:
+            self.webhook_digests.flush_all()
+            await self.webhook_dispatcher.close()
+            await self.webhooks.close()
+        if self.settling:
+            await asyncio.gather(*self.settling, return_exceptions=True)
+        if self.restore_task:
+            task = self.restore_task
+            self.restore_task = None
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        if self.sighting_queue:
+            await self.sighting_queue.close()
+        if self.write_behind:
+            await self.write_behind.close()
+        await self.db.close()
 
     def get_guild_subscription_channel(self, guild_id):
-        return self.guild_subscription_channels.get(guild_id, None)
+        config = self.guild_configs.get(guild_id)
+        return config.subscription_channel_id if config else None
+
+    def get_alert_expiry(self, guild_id, ttl=None):
+        # Absolute expiry for a request made now with a lifetime of `ttl`
+        # seconds, falling back to the guild's default. None never expires.
+        if not ttl:
+            config = self.guild_configs.get(guild_id)
+            ttl = config.alert_ttl if config else None
+
+        return time.time() + ttl if ttl else None
 
     def _add_alert_request(
-        self, user_id, guild_id, requester_id, channel_id, message_id
+        self, user_id, guild_id, requester_id, channel_id, message_id, expires_at=None
     ):
-        user_guild_pair = (user_id, guild_id)
-
-        if not user_guild_pair in self.alert_requests:
-            self.alert_requests[user_guild_pair] = {}
+        self.store.set_alert_request(
+            user_id, guild_id, requester_id, channel_id, message_id
+        )
 
-        self.alert_requests[user_guild_pair][requester_id] = (channel_id, message_id)
+        key = (user_id, guild_id, requester_id)
+        if expires_at:
+            self.expiry.set(key, expires_at)
+        else:
+            self.expiry.discard(key)
+
+    async def _expire_alert_requests(self, keys):
+        expired = []
+        for key in keys:
+            if self.store.remove_alert_request(*key):
+                expired.append(key)
+            elif self.store.get_alert_request(*key) is None:
+                # Claimed by a sighting whose alerts are still sending. Check
+                # back later in case the send fails and the request is restored.
+                self.expiry.set(key, time.time() + CLAIM_EXPIRY_RETRY)
+
+        if expired:
+            metrics.inc("alerts_expired", len(expired))
+            await self.writer.remove_alert_requests(expired)
 
     async def add_alert_request(
-        self, user_id, guild_id, requester_id, channel_id, message_id
+        self,
+        user_id,
+        guild_id,
+        requester_id,
+        channel_id,
+        message_id,
+        expires_at=None,
     ):
-        row = (user_id, guild_id, requester_id, channel_id, message_id)
-        user_guild_pair = (user_id, guild_id)
-
-        prev_channel = self.alert_requests.get(user_guild_pair, {}).get(
-            requester_id, [None]
-        )[0]
-        if prev_channel:
-            self.alert_requests[user_guild_pair][requester_id] = (
-                channel_id,
-                message_id,
-            )
-            await self.db.update_alert_request(*row)
+        row = (user_id, guild_id, requester_id, channel_id, message_id, expires_at)
 
-            return CommandResponse(OperationStatus.UPDATED, prev_channel)
+        prev = self.store.get_alert_request(user_id, guild_id, requester_id)
+        self._add_alert_request(*row)
 
+        # A claimed request is gone from the store but not from the database,
+        # so re-making it must not be staged as a fresh insert that a cancel
+        # could drop without deleting the old row
+        if prev or (user_id, guild_id, requester_id) in self.claimed:
+            await self.writer.update_alert_request(*row)
         else:
-            self._add_alert_request(*row)
-            await self.db.insert_alert_request(*row)
+            await self.writer.insert_alert_request(*row)
 
-            return CommandResponse(OperationStatus.INSERTED)
+        if prev:
+            return CommandResponse(OperationStatus.UPDATED, prev[0])
 
-    async def remove_alert_request(self, user_id, guild_id, requester_id):
-        row = (user_id, guild_id, requester_id)
-        user_guild_pair = (user_id, guild_id)
+        return CommandResponse(OperationStatus.INSERTED)
+
+    async def add_alert_requests(
+        self, user_ids, guild_id, requester_id, channel_id, message_id, expires_at=None
+    ):
+        # Bulk add_alert_request for one requester, written in one batch.
+        # Returns the user IDs that were newly watched and those already watched.
+        inserted = []
+        updated = []
+        rows = []
+        for user_id in user_ids:
+            prev = self.store.get_alert_request(user_id, guild_id, requester_id)
+            (updated if prev else inserted).append(user_id)
+
+            row = (user_id, guild_id, requester_id, channel_id, message_id, expires_at)
+            self._add_alert_request(*row)
+            rows.append(row)
+
+        if rows:
+            await self.writer.upsert_alert_requests(rows)
 
-        if self.alert_requests.get(user_guild_pair, {}).pop(requester_id, None):
-            await self.db.remove_alert_request(*row)
+        return CommandResponse(OperationStatus.SUCCESS, (inserted, updated))
 
-            # do some cleanup for unfollowed user/guild pairs
-            if (
-                user_guild_pair in self.alert_requests
-                and not self.alert_requests[user_guild_pair]
-            ):
-                self.alert_requests.pop(user_guild_pair)
+    async def remove_alert_request(self, user_id, guild_id, requester_id):
+        self.expiry.discard((user_id, guild_id, requester_id))
+        if self.store.remove_alert_request(user_id, guild_id, requester_id):
+            await self.writer.remove_alert_request(user_id, guild_id, requester_id)
 
             return CommandResponse(OperationStatus.SUCCESS)
 
         return CommandResponse(OperationStatus.NOTFOUND)
 
+    async def remove_alert_requests(self, keys):
+        # keys: iterable of (user_id, guild_id, requester_id)
+        removed = [
+            (user_id, guild_id, requester_id)
+            for user_id, guild_id, requester_id in keys
+            if self.store.remove_alert_request(user_id, guild_id, requester_id)
+        ]
+        for key in removed:
+            self.expiry.discard(key)
+
+        if not removed:
+            return CommandResponse(OperationStatus.NOTFOUND)
+
+        await self.writer.remove_alert_requests(removed)
+        return CommandResponse(OperationStatus.SUCCESS, removed)
+
+    async def clear_alert_requests(self, user_id, guild_id):
+        # Drop every request for a user/guild pair, returning requester_id -> (channel_id, message_id)
+        requests = self.store.pop_alert_requests(user_id, guild_id)
+        if not requests:
+            return CommandResponse(OperationStatus.NOTFOUND)
+
+        keys = [(user_id, guild_id, r) for r in requests]
+        for key in keys:
+            self.expiry.discard(key)
+
+        await self.writer.remove_alert_requests(keys)
+        return CommandResponse(OperationStatus.SUCCESS, requests)
+
     async def add_subscription(self, user_id, guild_id):
-        user_guild_pair = (user_id, guild_id)
-        if not user_guild_pair in self.subscriptions:
-            self.subscriptions.add(user_guild_pair)
-            await self.db.insert_subscription(*user_guild_pair)
+        if self.store.add_subscription(user_id, guild_id):
+            await self.writer.insert_subscription(user_id, guild_id)
             return CommandResponse(OperationStatus.INSERTED)
 
         return CommandResponse(OperationStatus.UPDATED)
 
     async def remove_subscription(self, user_id, guild_id):
-        user_guild_pair = (user_id, guild_id)
-        if user_guild_pair in self.subscriptions:
-            self.subscriptions.remove(user_guild_pair)
-            await self.db.remove_subscription(*user_guild_pair)
+        if self.store.remove_subscription(user_id, guild_id):
+            await self.writer.remove_subscription(user_id, guild_id)
             return CommandResponse(OperationStatus.SUCCESS)
 
         return CommandResponse(OperationStatus.NOTFOUND)
 
-    async def set_guild_subscription_channel(self, guild_id, channel_id):
-        prev_channel = self.get_guild_subscription_channel(guild_id)
+    async def add_subscriptions(self, user_ids, guild_id):
+        # Returns the user IDs newly subscribed to and those already subscribed to
+        inserted = []
+        existing = []
+        for user_id in user_ids:
+            if self.store.add_subscription(user_id, guild_id):
+                inserted.append(user_id)
+            else:
+                existing.append(user_id)
+
+        if inserted:
+            await self.writer.insert_subscriptions([(u, guild_id) for u in inserted])
+
+        return CommandResponse(OperationStatus.SUCCESS, (inserted, existing))
+
+    async def remove_subscriptions(self, user_ids, guild_id):
+        removed = [u for u in user_ids if self.store.remove_subscription(u, guild_id)]
+        if not removed:
+            return CommandResponse(OperationStatus.NOTFOUND)
+
+        await self.writer.remove_subscriptions([(u, guild_id) for u in removed])
+        return CommandResponse(OperationStatus.SUCCESS, removed)
+
+    async def purge_guild(self, guild_id):
+        # Drops every alert request and subscription in a guild the bot has left
+        alerts = await self.remove_alert_requests(self.store.guild_alert_keys(guild_id))
+        subscriptions = await self.remove_subscriptions(
+            list(self.store.guild_subscriptions(guild_id)), guild_id
+        )
+        return self._purged(alerts, subscriptions)
+
+    async def purge_requester(self, guild_id, requester_id):
+        # Drops the alert requests made by a member who has left
+        alerts = await self.remove_alert_requests(
+            self.store.requester_alert_keys(guild_id, requester_id)
+        )
+        return self._purged(alerts)
+
+    async def purge_channel(self, guild_id, channel_id):
+        # Drops the alert requests pointing at a deleted channel, and stops
+        # forwarding subscriptions to it
+        alerts = await self.remove_alert_requests(
+            self.store.channel_alert_keys(channel_id)
+        )
+
+        config = self.guild_configs.get(guild_id)
+        if config and config.subscription_channel_id == channel_id:
+            if self.webhooks:
+                self.webhooks.forget(channel_id)
+            config.subscription_channel_id = None
+            config.webhook_id = None
+            config.webhook_token = None
+            await self.writer.upsert_guild_subscription_config(*config.row())
+
+        return self._purged(alerts)
+
+    def _purged(self, alerts, subscriptions=None):
+        # Counts removed by the remove_* responses of a purge
+        counts = [0, 0]
+        for i, res in enumerate((alerts, subscriptions)):
+            if res and res.status == OperationStatus.SUCCESS:
+                counts[i] = len(res.data)
+
+        metrics.inc("purged_alert_requests", counts[0])
+        metrics.inc("purged_subscriptions", counts[1])
+        return CommandResponse(OperationStatus.SUCCESS, tuple(counts))
+
+    def get_guild_watch_list(self, guild_id):
+        # Returns ([(user_id, requester_id, channel_id, message_id)], [user_id])
+        # for everything watched in a guild
+        return (
+            sorted(self.store.guild_alert_requests(guild_id)),
+            sorted(self.store.guild_subscriptions(guild_id)),
+        )
+
+    def list_alert_requests(
+        self, guild_id, requester_id=None, after=None, limit=util.LIST_PAGE_SIZE
+    ):
+        # A page of a guild's alert requests, or of one requester's, ordered by
+        # (user_id, requester_id) from the cursor `after`. Read from the sorted
+        # guild or requester index in O(log n + limit). Returns ([(user_id,
+        # requester_id, channel_id, message_id, expires_at)], cursor for the
+        # next page or None)
+        if requester_id is None:
+            rows = self.store.guild_alert_requests(guild_id, after)
+        else:
+            rows = (
+                (u, requester_id, c, m)
+                for u, c, m in self.store.requester_alert_requests(
+                    guild_id, requester_id, after[0] if after else None
+                )
+            )
+
+        page, next_after = util.keyset_page(rows, limit, lambda r: r[:2])
+        return [
+            (u, r, c, m, self.expiry.get((u, guild_id, r))) for u, r, c, m in page
+        ], next_after
+
+    def list_subscriptions(self, guild_id, after=None, limit=util.LIST_PAGE_SIZE):
+        # A page of the user IDs subscribed to in a guild, in order from the
+        # cursor `after`, and the cursor for the next page or None
+        return util.keyset_page(
+            self.store.guild_subscriptions(guild_id, after), limit, lambda u: u
+        )
+
+    async def set_guild_subscription_channel(
+        self, guild_id, channel_id, digest_window=None, digest_size=None
+    ):
+        # A falsy digest_window turns digests off and forwards every message on its own
+        config = self.guild_configs.get(guild_id)
 
         ret = CommandResponse(OperationStatus.INSERTED)
-        db_func = self.db.insert_guild_subscription_config
-        if prev_channel:
+        if config and config.subscription_channel_id:
+            ret = CommandResponse(
+                OperationStatus.UPDATED, config.subscription_channel_id
+            )
 
-            db_func = self.db.update_guild_subscription_config
-            ret = CommandResponse(OperationStatus.UPDATED, prev_channel)
+        if not config:
+            config = self.guild_configs[guild_id] = GuildSubscriptionConfig(
+                guild_id, None
+            )
 
-        self.guild_subscription_channels[guild_id] = channel_id
-        await db_func(guild_id, channel_id)
+        if (
+            config.subscription_channel_id
+            and config.subscription_channel_id != channel_id
+        ):
+            # Send whatever is buffered for the old channel before moving on
+            self.digests.flush(config.subscription_channel_id)
+
+            # The webhook belongs to the old channel, even if webhooks have
+            # since been turned off
+            if config.webhook_id and self.webhooks:
+                self.webhook_digests.flush(config.webhook_id)
+                await self.webhooks.delete(config)
+            config.webhook_id = None
+            config.webhook_token = None
+
+        config.subscription_channel_id = channel_id
+        config.digest_window = digest_window or None
+        config.digest_size = digest_size or None
+
+        await self.writer.upsert_guild_subscription_config(*config.row())
         return ret
 
-    async def handle_user_sighting(self, user, guild, message):
-        user_guild_pair = (user.id, guild.id)
+    async def enable_subscription_webhook(self, channel):
+        # Routes forwards for the guild's subscription channel through a webhook
+        # created in it. Returns INSERTED when a webhook was created, UPDATED if
+        # one already existed, and NOTFOUND if it can't be created.
+        config = self.guild_configs.get(channel.guild.id)
+        if (
+            not self.webhooks
+            or not config
+            or config.subscription_channel_id != channel.id
+        ):
+            return CommandResponse(OperationStatus.NOTFOUND)
+
+        if config.webhook_id:
+            return CommandResponse(OperationStatus.UPDATED)
+
+        webhook = await self.webhooks.create(channel)
+        if not webhook:
+            return CommandResponse(OperationStatus.NOTFOUND)
+
+        config.webhook_id = webhook.id
+        config.webhook_token = webhook.token
+        await self.writer.upsert_guild_subscription_config(*config.row())
+
+        return CommandResponse(OperationStatus.INSERTED)
+
+    def _webhook_lost(self, guild_id, channel_id):
+        # The webhook for a subscription channel was deleted; forwards go out
+        # as the bot until it is set up again
+        self.webhooks.forget(channel_id)
+
+        config = self.guild_configs.get(guild_id)
+        if not config or config.subscription_channel_id != channel_id:
+            return
+        if not config.webhook_id:
+            return
+
+        config.webhook_id = None
+        config.webhook_token = None
+        metrics.inc("webhooks_lost")
+
+        task = asyncio.create_task(
+            self.writer.upsert_guild_subscription_config(*config.row())
+        )
+        self.settling.add(task)
+        task.add_done_callback(self.settling.discard)
+
+    async def set_guild_alert_ttl(self, guild_id, alert_ttl):
+        # Default lifetime in seconds for new alert requests; a falsy value
+        # makes them last until the user speaks. Existing requests keep theirs.
+        config = self.guild_configs.get(guild_id)
+        if not config:
+            config = self.guild_configs[guild_id] = GuildSubscriptionConfig(
+                guild_id, None
+            )
 
-        alert_requests = self.alert_requests.get(user_guild_pair, {})
+        config.alert_ttl = alert_ttl or None
+        await self.writer.upsert_guild_subscription_config(*config.row())
 
-        alerts_to_send = []
-        if alert_requests:
-            raw_alerts = {}
-            for u, (c, m) in alert_requests.items():
-                if not c in raw_alerts:
-                    raw_alerts[c] = {}
+        return CommandResponse(OperationStatus.SUCCESS)
 
-                raw_alerts[c][u] = m
+    def _resolve_alerts(self, guild, alert_requests):
+        # Group requests by destination channel, keeping only channels we can
+        # post in and requesters who are still around and can read them
+        alerts_to_send = []
 
-            for c in raw_alerts:
-                channel = guild.get_channel(c)
-                if not util.channel_accessible(channel):
+        raw_alerts = {}
+        for u, (c, m) in alert_requests.items():
+            if not c in raw_alerts:
+                raw_alerts[c] = {}
+
+            raw_alerts[c][u] = m
+
+        for c in raw_alerts:
+            channel = guild.get_channel(c)
+            if not util.channel_accessible(channel, self.permissions):
+                continue
+            users = []
+            message_ids = []
+            for u in raw_alerts[c]:
+                member = guild.get_member(u)
+                if not member:
                     continue
-                users = []
-                message_ids = []
-                for u in raw_alerts[c]:
-                    member = guild.get_member(u)
-                    if not member:
-                        continue
-                    if not channel.permissions_for(member).read_messages:
-                        continue
-                    users.append(member)
-                    message_ids.append(raw_alerts[c][u])
-
-                if users:
-                    alerts_to_send.append((channel, users, message_ids))
-
-        subscription_channel = None
-        if user_guild_pair in self.subscriptions:
-            channel = guild.get_channel(self.get_guild_subscription_channel(guild.id))
-            if util.channel_accessible(channel):
-                subscription_channel = channel
-
-        embed = None
-        if alert_requests or subscription_channel:
-            embed = util.build_message_embed(message)
+                if not self.permissions.permissions_for(channel, member).read_messages:
+                    continue
+                users.append(u)
+                message_ids.append(raw_alerts[c][u])
+
+            if users:
+                alerts_to_send.append((channel, users, message_ids))
+
+        return alerts_to_send
+
+    def _resolve_subscription_channel(self, user, guild):
+        if not self.store.has_subscription(user.id, guild.id):
+            return None
+
+        config = self.guild_configs.get(guild.id)
+        channel = guild.get_channel(config.subscription_channel_id if config else None)
+        if not channel:
+            return None
+
+        # A webhook posts regardless of the bot's own permissions in the channel
+        if self.webhooks and config.webhook_id:
+            return self.webhooks.get(config)
+
+        if util.channel_accessible(channel, self.permissions):
+            return channel
+
+        return None
+
+    def submit_sighting(self, message):
+        # Hands a message to the intake instead of handling it inline. Sightings
+        # that can fulfil alert requests are queued ahead of forwards.
+        user = message.author
+        if user.id not in self.watched_users:
+            return
 
+        self.intake.submit(
+            message, bool(self.store.get_alert_requests(user.id, message.guild.id))
+        )
+
+    async def _handle_intake(self, message):
+        with metrics.timer("on_message"):
+            await self.handle_user_sighting(message.author, message.guild, message)
+
+    def _summarize_shed(self, guild, shed):
+        # Tells a guild's subscription channel which forwards the intake shed
+        channel = guild.get_channel(self.get_guild_subscription_channel(guild.id))
+        if not util.channel_accessible(channel, self.permissions):
+            return
+
+        counts = sorted(shed.items(), key=lambda i: -i[1])
+        lines = [f"<@{u}>: {n}" for u, n in counts[:20]]
+        if len(counts) > 20:
+            lines.append(f"and {len(counts) - 20} more users")
+
+        self.dispatcher.submit(
+            channel,
+            SUBSCRIPTION,
+            "Too many messages to keep up with; these were not forwarded:\n"
+            + "\n".join(lines),
+            allowed_mentions=discord.AllowedMentions.none(),
+        )
+
+    async def handle_user_sighting(self, user, guild, message):
+        if user.id not in self.watched_users:
+            return
+
+        metrics.inc("sightings")
+
+        with metrics.timer("sighting_resolve"):
+            # Claim the pending requests before doing any I/O, so sightings
+            # arriving while these alerts are in flight find nothing to send
+            alert_requests = self.store.pop_alert_requests(user.id, guild.id)
+
+            alerts_to_send = []
+            if alert_requests:
+                alerts_to_send = self._resolve_alerts(guild, alert_requests)
+
+            subscription_channel = self._resolve_subscription_channel(user, guild)
+
+        subscription = None
         if subscription_channel:
-            await subscription_channel.send(embed=embed)
+            config = self.guild_configs[guild.id]
+            subscription = (
+                subscription_channel,
+                config.digest_window,
+                config.digest_size,
+            )
+
+        if self.sighting_queue:
+            await self._queue_sighting(
+                user, guild, message, subscription, alerts_to_send, alert_requests
+            )
+            return
+
+        # Only render the embed once a destination has survived the permission checks
+        results = []
+        if alerts_to_send or subscription:
+            with metrics.timer("sighting_embed"):
+                embed = util.build_message_embed(message)
+
+            if subscription and isinstance(subscription[0], WebhookChannel):
+                deliver(
+                    self.webhook_dispatcher,
+                    self.webhook_digests,
+                    guild,
+                    embed,
+                    subscription,
+                )
+                subscription = None
+
+            # Sends are handed to the dispatcher and carry on in the background
+            results = deliver(
+                self.dispatcher,
+                self.digests,
+                guild,
+                embed,
+                subscription,
+                alerts_to_send,
+            )
+
+        if not alert_requests:
+            return
+
+        self.claimed.update((user.id, guild.id, r) for r in alert_requests)
+        if not results:
+            with metrics.timer("sighting_cleanup"):
+                await self._settle_claim(user.id, guild.id, alert_requests)
+            return
+
+        task = asyncio.create_task(
+            self._settle_claim(
+                user.id, guild.id, alert_requests, alerts_to_send, results
+            )
+        )
+        self.settling.add(task)
+        task.add_done_callback(self.settling.discard)
+
+    async def _settle_claim(
+        self, user_id, guild_id, claimed, alerts_to_send=(), results=()
+    ):
+        # Once the alerts for a claim are out, delete the fulfilled requests.
+        # Requesters whose alert failed to send get their request back,
+        # unless they have made a new one in the meantime.
+        try:
+            sent = await asyncio.gather(*results)
+        finally:
+            self.claimed.difference_update((user_id, guild_id, r) for r in claimed)
+
+        failed = set()
+        for (_, requester_ids, _), ok in zip(alerts_to_send, sent):
+            if not ok:
+                failed.update(requester_ids)
+
+        for r in failed:
+            if self.store.get_alert_request(user_id, guild_id, r) is None:
+                self._add_alert_request(
+                    user_id,
+                    guild_id,
+                    r,
+                    *claimed[r],
+                    self.expiry.get((user_id, guild_id, r)),
+                )
+                metrics.inc("claims_restored")
+
+        # A request re-made since the claim has already replaced the old row
+        fulfilled = [
+            (user_id, guild_id, r)
+            for r in claimed
+            if r not in failed
+            and self.store.get_alert_request(user_id, guild_id, r) is None
+        ]
+        if fulfilled:
+            for key in fulfilled:
+                self.expiry.discard(key)
+            await self.writer.remove_alert_requests(fulfilled)
+
+    async def _queue_sighting(
+        self, user, guild, message, subscription, alerts_to_send, alert_requests
+    ):
+        # The worker that picks the record up owns the database cleanup; the
+        # claimed requests are already gone from memory, and come back through
+        # _poll_restored if their alert fails to send
+        fulfilled = {}
+        for r, (c, m) in (alert_requests or {}).items():
+            key = (user.id, guild.id, r)
+            fulfilled[r] = (c, m, self.expiry.get(key))
+            self.expiry.discard(key)
+
+        if fulfilled and self.write_behind:
+            # Cancel any staged insert so a late flush can't bring the row back
+            await self.write_behind.remove_alert_requests(
+                [(user.id, guild.id, r) for r in fulfilled]
+            )
+
+        if not (subscription or alerts_to_send or fulfilled):
+            return
+
+        if subscription:
+            subscription = (subscription[0].id, *subscription[1:])
 
-        for c, u, m in alerts_to_send:
-            await c.send(
-                " ".join(f"<@{d.id}>" for d in u),
-                embed=embed,
-                view=util.build_jump_view(guild, c, m),
+        with metrics.timer("sighting_queue"):
+            await self.sighting_queue.push(
+                encode_sighting(
+                    message,
+                    subscription,
+                    [(c.id, u, m) for c, u, m in alerts_to_send],
+                    fulfilled,
+                )
             )
 
-        for u in list(alert_requests.keys()):
-            await self.remove_alert_request(*user_guild_pair, u)
+    async def _poll_restored(self):
+        # Puts back alert requests that split mode workers failed to alert,
+        # unless they have been made again since. Their rows were left in the
+        # database, but may have been removed or replaced in the meantime.
+        while True:
+            await asyncio.sleep(RESTORE_POLL_INTERVAL)
+            try:
+                rows = await self.sighting_queue.claim_restored(
+                    shard_count=self.shard_count, shard_ids=self.shard_ids
+                )
+                restored = [
+                    row
+                    for row in rows
+                    if self.store.get_alert_request(*row[:3]) is None
+                ]
+                for row in restored:
+                    self._add_alert_request(*row)
+                if restored:
+                    metrics.inc("claims_restored", len(restored))
+                    await self.writer.upsert_alert_requests(restored)
+            except Exception as e:
+                print(
+                    "".join(traceback.TracebackException.from_exception(e).format()),
+                    file=sys.stderr,
+                )
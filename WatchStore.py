@@ -0,0 +1,462 @@
+import bisect
+import sys
+from array import array
+
+
+class WatchStore:
+    # In-memory alert requests and subscriptions, keyed by (user_id, guild_id)
+    # tuples. This is the default store, and the reference for CompactWatchStore.
+
+    def __init__(self):
+        # (user_id, guild_id) -> {requester_id: (channel_id, message_id)}
+        self.alert_requests = {}
+        self.subscriptions = set()
+
+        # user_id -> number of user/guild pairs with alerts or a subscription.
+        # Checked before anything else on every message, so that unwatched
+        # authors are rejected without building any keys.
+        self.watched_users = {}
+        # Alert requests held, kept as they are indexed so reading it is O(1)
+        self.alert_request_total = 0
+
+        # Secondary indexes for finding everything tied to a guild, requester
+        # or destination channel without a scan. Shared by both stores. Each
+        # is kept sorted, so they can also be read a page at a time from a
+        # cursor in O(log n + page).
+        # guild_id -> sorted [user_id] with alert requests
+        self.guild_alerts = {}
+        # guild_id -> sorted [user_id] subscribed to
+        self.guild_subscription_users = {}
+        # (guild_id, requester_id) -> sorted [user_id]
+        self.requester_alerts = {}
+        # channel_id -> sorted [(user_id, guild_id, requester_id)]
+        self.channel_alerts = {}
+
+    def _watch(self, user_id):
+        self.watched_users[user_id] = self.watched_users.get(user_id, 0) + 1
+
+    def _unwatch(self, user_id):
+        count = self.watched_users.pop(user_id, 0) - 1
+        if count > 0:
+            self.watched_users[user_id] = count
+
+    def _index_add(self, index, key, value):
+        values = index.get(key)
+        if values is None:
+            values = index[key] = []
+
+        # Loads come in primary key order, so most entries go on the end
+        if not values or values[-1] < value:
+            values.append(value)
+            return
+
+        i = bisect.bisect_left(values, value)
+        if i == len(values) or values[i] != value:
+            values.insert(i, value)
+
+    def _index_remove(self, index, key, value):
+        values = index.get(key)
+        if values is None:
+            return
+
+        i = bisect.bisect_left(values, value)
+        if i < len(values) and values[i] == value:
+            del values[i]
+        if not values:
+            del index[key]
+
+    def _users_from(self, values, start):
+        # Yields the user IDs of a sorted index from `start` on, or all of them
+        i = 0 if start is None else bisect.bisect_left(values, start)
+        for i in range(i, len(values)):
+            yield values[i]
+
+    def _requester_key(self, guild_id, requester_id):
+        return (guild_id, requester_id)
+
+    def _index_alert(self, user_id, guild_id, requester_id, channel_id):
+        self.alert_request_total += 1
+        self._index_add(
+            self.requester_alerts, self._requester_key(guild_id, requester_id), user_id
+        )
+        self._index_add(
+            self.channel_alerts, channel_id, (user_id, guild_id, requester_id)
+        )
+
+    def _unindex_alert(self, user_id, guild_id, requester_id, channel_id):
+        self.alert_request_total -= 1
+        self._index_remove(
+            self.requester_alerts, self._requester_key(guild_id, requester_id), user_id
+        )
+        self._index_remove(
+            self.channel_alerts, channel_id, (user_id, guild_id, requester_id)
+        )
+
+    def alert_request_count(self):
+        return self.alert_request_total
+
+    def subscription_count(self):
+        return len(self.subscriptions)
+
+    def get_alert_requests(self, user_id, guild_id):
+        # requester_id -> (channel_id, message_id). Treat as read-only.
+        return self.alert_requests.get((user_id, guild_id), {})
+
+    def get_alert_request(self, user_id, guild_id, requester_id):
+        return self.alert_requests.get((user_id, guild_id), {}).get(requester_id)
+
+    def set_alert_request(
+        self, user_id, guild_id, requester_id, channel_id, message_id
+    ):
+        user_guild_pair = (user_id, guild_id)
+
+        if not user_guild_pair in self.alert_requests:
+            self.alert_requests[user_guild_pair] = {}
+            self._watch(user_id)
+            self._index_add(self.guild_alerts, guild_id, user_id)
+
+        requests = self.alert_requests[user_guild_pair]
+        prev = requests.get(requester_id)
+        if prev:
+            self._unindex_alert(user_id, guild_id, requester_id, prev[0])
+
+        requests[requester_id] = (channel_id, message_id)
+        self._index_alert(user_id, guild_id, requester_id, channel_id)
+
+    def remove_alert_request(self, user_id, guild_id, requester_id):
+        user_guild_pair = (user_id, guild_id)
+
+        requests = self.alert_requests.get(user_guild_pair)
+        if not requests or requester_id not in requests:
+            return False
+
+        channel_id, _ = requests.pop(requester_id)
+        self._unindex_alert(user_id, guild_id, requester_id, channel_id)
+
+        # do some cleanup for unfollowed user/guild pairs
+        if not requests:
+            self.alert_requests.pop(user_guild_pair)
+            self._unwatch(user_id)
+            self._index_remove(self.guild_alerts, guild_id, user_id)
+
+        return True
+
+    def pop_alert_requests(self, user_id, guild_id):
+        requests = self.alert_requests.pop((user_id, guild_id), None)
+        if requests:
+            self._unwatch(user_id)
+            self._index_remove(self.guild_alerts, guild_id, user_id)
+            for r, (c, _) in requests.items():
+                self._unindex_alert(user_id, guild_id, r, c)
+
+        return requests
+
+    def has_subscription(self, user_id, guild_id):
+        return (user_id, guild_id) in self.subscriptions
+
+    def add_subscription(self, user_id, guild_id):
+        user_guild_pair = (user_id, guild_id)
+        if user_guild_pair in self.subscriptions:
+            return False
+
+        self.subscriptions.add(user_guild_pair)
+        self._watch(user_id)
+        self._index_add(self.guild_subscription_users, guild_id, user_id)
+        return True
+
+    def remove_subscription(self, user_id, guild_id):
+        user_guild_pair = (user_id, guild_id)
+        if not user_guild_pair in self.subscriptions:
+            return False
+
+        self.subscriptions.remove(user_guild_pair)
+        self._unwatch(user_id)
+        self._index_remove(self.guild_subscription_users, guild_id, user_id)
+        return True
+
+    def guild_alert_requests(self, guild_id, after=None):
+        # Yields (user_id, requester_id, channel_id, message_id) for a guild in
+        # (user_id, requester_id) order, starting after that pair if given
+        # The cursor's own user may still have requesters after it
+        after_user, after_requester = after if after is not None else (None, None)
+
+        for u in self._users_from(self.guild_alerts.get(guild_id, ()), after_user):
+            for r, (c, m) in sorted(self.get_alert_requests(u, guild_id).items()):
+                if u != after_user or r > after_requester:
+                    yield u, r, c, m
+
+    def guild_subscriptions(self, guild_id, after=None):
+        # Yields the user IDs subscribed to in a guild in order, starting
+        # after `after` if given
+        return self._users_from(
+            self.guild_subscription_users.get(guild_id, ()),
+            None if after is None else after + 1,
+        )
+
+    def requester_alert_requests(self, guild_id, requester_id, after=None):
+        # Yields (user_id, channel_id, message_id) for one requester's requests
+        # in user order, starting after the user ID `after` if given
+        key = self._requester_key(guild_id, requester_id)
+        start = None if after is None else after + 1
+        for u in self._users_from(self.requester_alerts.get(key, ()), start):
+            request = self.get_alert_request(u, guild_id, requester_id)
+            if request:
+                yield (u, *request)
+
+    def guild_alert_keys(self, guild_id):
+        return [
+            (u, guild_id, r)
+            for u in self.guild_alerts.get(guild_id, ())
+            for r in self.get_alert_requests(u, guild_id)
+        ]
+
+    def requester_alert_keys(self, guild_id, requester_id):
+        key = self._requester_key(guild_id, requester_id)
+        return [(u, guild_id, requester_id) for u in self.requester_alerts.get(key, ())]
+
+    def channel_alert_keys(self, channel_id):
+        return list(self.channel_alerts.get(channel_id, ()))
+
+    def memory_usage(self):
+        # Approximate bytes held by the alert and subscription indexes
+        size = sys.getsizeof(self.alert_requests) + sys.getsizeof(self.subscriptions)
+
+        for (u, g), requests in self.alert_requests.items():
+            size += sys.getsizeof((u, g)) + sys.getsizeof(u) + sys.getsizeof(g)
+            size += sys.getsizeof(requests)
+            for r, (c, m) in requests.items():
+                size += sys.getsizeof(r) + sys.getsizeof((c, m))
+                size += sys.getsizeof(c) + sys.getsizeof(m)
+
+        for u, g in self.subscriptions:
+            size += sys.getsizeof((u, g)) + sys.getsizeof(u) + sys.getsizeof(g)
+
+        return size + self._index_memory_usage()
+
+    def _index_memory_usage(self):
+        # The IDs in the indexes are the same int objects as in the primary
+        # structures, so only the containers and the tuples are counted
+        size = sys.getsizeof(self.watched_users)
+        for index in (
+            self.guild_alerts,
+            self.guild_subscription_users,
+            self.requester_alerts,
+            self.channel_alerts,
+        ):
+            size += sys.getsizeof(index)
+            for values in index.values():
+                size += sys.getsizeof(values)
+
+        for k in self.requester_alerts:
+            size += sys.getsizeof(k)
+        for values in self.channel_alerts.values():
+            for key in values:
+                size += sys.getsizeof(key)
+        return size
+
+
+def pack_pair(a, b):
+    # Two 64-bit snowflakes as a single int
+    return (a << 64) | b
+
+
+def _flat_bisect(values, stride, entry):
+    # Position of the first entry not below `entry` in a flat array of sorted
+    # `stride`-int entries
+    if stride == 1:
+        return bisect.bisect_left(values, entry[0])
+
+    # Loads come in primary key order, so most entries go on the end
+    n = len(values)
+    if not n or tuple(values[n - stride :]) < entry:
+        return n
+
+    lo, hi = 0, len(values) // stride
+    while lo < hi:
+        mid = (lo + hi) // 2
+        i = mid * stride
+        if tuple(values[i : i + stride]) < entry:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo * stride
+
+
+class CompactWatchStore(WatchStore):
+    # Same API as WatchStore, but user/guild pairs are packed into one int and
+    # each pair's requests live in a flat array of unsigned 64-bit
+    # [requester_id, channel_id, message_id, ...] triples. A missing message ID
+    # is stored as 0.
+    #
+    # The secondary indexes hold sorted flat arrays too: user IDs, or
+    # [user_id, guild_id, requester_id, ...] triples for channel_alerts, and
+    # requester_alerts is keyed by pack_pair(guild_id, requester_id).
+
+    def __init__(self):
+        super().__init__()
+
+        # pack_pair(user_id, guild_id) -> array("Q")
+        self.alert_requests = {}
+        # pack_pair(user_id, guild_id)
+        self.subscriptions = set()
+
+    def _requester_key(self, guild_id, requester_id):
+        return pack_pair(guild_id, requester_id)
+
+    def _index_add(self, index, key, value):
+        entry = value if isinstance(value, tuple) else (value,)
+        values = index.get(key)
+        if values is None:
+            values = index[key] = array("Q")
+
+        i = _flat_bisect(values, len(entry), entry)
+        if i == len(values):
+            values.extend(entry)
+        elif tuple(values[i : i + len(entry)]) != entry:
+            values[i:i] = array("Q", entry)
+
+    def _index_remove(self, index, key, value):
+        values = index.get(key)
+        if values is None:
+            return
+
+        entry = value if isinstance(value, tuple) else (value,)
+        i = _flat_bisect(values, len(entry), entry)
+        if tuple(values[i : i + len(entry)]) == entry:
+            del values[i : i + len(entry)]
+        if not values:
+            del index[key]
+
+    def channel_alert_keys(self, channel_id):
+        values = self.channel_alerts.get(channel_id, ())
+        return [tuple(values[i : i + 3]) for i in range(0, len(values), 3)]
+
+    def _find(self, requests, requester_id):
+        for i in range(0, len(requests), 3):
+            if requests[i] == requester_id:
+                return i
+
+        return -1
+
+    def get_alert_requests(self, user_id, guild_id):
+        requests = self.alert_requests.get(pack_pair(user_id, guild_id))
+        if not requests:
+            return {}
+
+        return {
+            requests[i]: (requests[i + 1], requests[i + 2] or None)
+            for i in range(0, len(requests), 3)
+        }
+
+    def get_alert_request(self, user_id, guild_id, requester_id):
+        requests = self.alert_requests.get(pack_pair(user_id, guild_id))
+        if not requests:
+            return None
+
+        i = self._find(requests, requester_id)
+        if i < 0:
+            return None
+
+        return (requests[i + 1], requests[i + 2] or None)
+
+    def set_alert_request(
+        self, user_id, guild_id, requester_id, channel_id, message_id
+    ):
+        key = pack_pair(user_id, guild_id)
+
+        requests = self.alert_requests.get(key)
+        if requests is None:
+            requests = self.alert_requests[key] = array("Q")
+            self._watch(user_id)
+            self._index_add(self.guild_alerts, guild_id, user_id)
+
+        i = self._find(requests, requester_id)
+        if i < 0:
+            requests.extend((requester_id, channel_id, message_id or 0))
+        else:
+            self._unindex_alert(user_id, guild_id, requester_id, requests[i + 1])
+            requests[i + 1] = channel_id
+            requests[i + 2] = message_id or 0
+
+        self._index_alert(user_id, guild_id, requester_id, channel_id)
+
+    def remove_alert_request(self, user_id, guild_id, requester_id):
+        key = pack_pair(user_id, guild_id)
+
+        requests = self.alert_requests.get(key)
+        if not requests:
+            return False
+
+        i = self._find(requests, requester_id)
+        if i < 0:
+            return False
+
+        self._unindex_alert(user_id, guild_id, requester_id, requests[i + 1])
+        del requests[i : i + 3]
+
+        if not requests:
+            self.alert_requests.pop(key)
+            self._unwatch(user_id)
+            self._index_remove(self.guild_alerts, guild_id, user_id)
+
+        return True
+
+    def pop_alert_requests(self, user_id, guild_id):
+        requests = self.get_alert_requests(user_id, guild_id)
+        if not requests:
+            return None
+
+        self.alert_requests.pop(pack_pair(user_id, guild_id))
+        self._unwatch(user_id)
+        self._index_remove(self.guild_alerts, guild_id, user_id)
+        for r, (c, _) in requests.items():
+            self._unindex_alert(user_id, guild_id, r, c)
+        return requests
+
+    def has_subscription(self, user_id, guild_id):
+        return pack_pair(user_id, guild_id) in self.subscriptions
+
+    def add_subscription(self, user_id, guild_id):
+        key = pack_pair(user_id, guild_id)
+        if key in self.subscriptions:
+            return False
+
+        self.subscriptions.add(key)
+        self._watch(user_id)
+        self._index_add(self.guild_subscription_users, guild_id, user_id)
+        return True
+
+    def remove_subscription(self, user_id, guild_id):
+        key = pack_pair(user_id, guild_id)
+        if not key in self.subscriptions:
+            return False
+
+        self.subscriptions.remove(key)
+        self._unwatch(user_id)
+        self._index_remove(self.guild_subscription_users, guild_id, user_id)
+        return True
+
+    def memory_usage(self):
+        size = sys.getsizeof(self.alert_requests) + sys.getsizeof(self.subscriptions)
+
+        for k, requests in self.alert_requests.items():
+            size += sys.getsizeof(k) + sys.getsizeof(requests)
+
+        for k in self.subscriptions:
+            size += sys.getsizeof(k)
+
+        # Nothing else holds on to the IDs used as keys here
+        size += sys.getsizeof(self.watched_users)
+        for u in self.watched_users:
+            size += sys.getsizeof(u)
+        for index in (
+            self.guild_alerts,
+            self.guild_subscription_users,
+            self.requester_alerts,
+            self.channel_alerts,
+        ):
+            size += sys.getsizeof(index)
+            for k, values in index.items():
+                size += sys.getsizeof(k) + sys.getsizeof(values)
+
+        return size
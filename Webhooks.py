@@ -0,0 +1,98 @@
+import aiohttp
+import disnake as discord
+
+
+class WebhookChannel:
+    # Channel-like wrapper around a webhook, so dispatchers and digests can send
+    # through it as they would through a channel. Queues are keyed by `id`,
+    # which is the webhook's rather than the channel's, so webhook sends never
+    # share a queue or bucket with the bot's own messages.
+
+    def __init__(self, webhook, guild_id, channel_id, on_lost):
+        self.webhook = webhook
+        self.id = webhook.id
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.on_lost = on_lost
+
+    async def send(self, content=None, **kwargs):
+        if content is not None:
+            kwargs["content"] = content
+
+        try:
+            return await self.webhook.send(**kwargs)
+        except discord.NotFound:
+            # Deleted from the channel settings; fall back to sending as the bot
+            self.on_lost(self.guild_id, self.channel_id)
+            raise
+
+
+class SubscriptionWebhooks:
+    # Creates one webhook per subscription channel and caches the clients for
+    # them. Webhook requests go over a session of their own rather than the
+    # bot's HTTP client.
+
+    def __init__(self, on_lost):
+        self.on_lost = on_lost
+        self.session = None
+        # channel_id -> WebhookChannel
+        self.channels = {}
+
+    def size(self):
+        return len(self.channels)
+
+    def _session(self):
+        if not self.session:
+            self.session = aiohttp.ClientSession()
+        return self.session
+
+    def get(self, config):
+        # The WebhookChannel for a guild's subscription channel, or None if it
+        # has no webhook
+        if not config.webhook_id:
+            return None
+
+        channel = self.channels.get(config.subscription_channel_id)
+        if not channel or channel.id != config.webhook_id:
+            webhook = discord.Webhook.partial(
+                config.webhook_id, config.webhook_token, session=self._session()
+            )
+            channel = self.channels[config.subscription_channel_id] = WebhookChannel(
+                webhook, config.guild_id, config.subscription_channel_id, self.on_lost
+            )
+
+        return channel
+
+    async def create(self, channel):
+        # Returns the new webhook, or None without Manage Webhooks or when
+        # Discord refuses, e.g. with the channel at its webhook limit
+        if not channel.permissions_for(channel.guild.me).manage_webhooks:
+            return None
+
+        try:
+            return await channel.create_webhook(
+                name=channel.guild.me.display_name, reason="Subscription forwarding"
+            )
+        except discord.HTTPException:
+            return None
+
+    async def delete(self, config):
+        # Best effort; the webhook may already be gone
+        self.forget(config.subscription_channel_id)
+        if not config.webhook_id:
+            return
+
+        try:
+            await discord.Webhook.partial(
+                config.webhook_id, config.webhook_token, session=self._session()
+            ).delete(reason="Subscription forwarding moved")
+        except discord.HTTPException:
+            pass
+
+    def forget(self, channel_id):
+        self.channels.pop(channel_id, None)
+
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
@@ -0,0 +1,168 @@
+import asyncio
+import sys
+import traceback
+
+
+class WriteBehindQueue:
+    # Stands in for DBInterface's write methods. Mutations are staged in memory,
+    # coalesced per primary key and written out by DBInterface.apply_batch
+    # every `interval` seconds, or as soon as `max_pending` keys are staged.
+
+    def __init__(self, db, interval=1.0, max_pending=500):
+        self.db = db
+        self.interval = interval
+        self.max_pending = max_pending
+
+        # key -> (row, fresh). A row of None is a pending delete. `fresh` marks
+        # rows that were inserted since the last flush, and so are not in the
+        # database yet; deleting one of those cancels both operations.
+        self.alert_requests = {}
+        self.subscriptions = {}
+        self.guild_subscription_configs = {}
+
+        self.lock = asyncio.Lock()
+        self.task = None
+
+    def pending(self):
+        return (
+            len(self.alert_requests)
+            + len(self.subscriptions)
+            + len(self.guild_subscription_configs)
+        )
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(
+                    "".join(traceback.TracebackException.from_exception(e).format()),
+                    file=sys.stderr,
+                )
+
+    async def _stage(self, pending, key, row, inserted=False):
+        self._stage_one(pending, key, row, inserted)
+
+        if self.pending() >= self.max_pending:
+            await self.flush()
+
+    def _stage_one(self, pending, key, row, inserted=False):
+        prev = pending.get(key)
+
+        if row is None:
+            if prev and prev[1]:
+                pending.pop(key)
+            else:
+                pending[key] = (None, False)
+        else:
+            pending[key] = (row, prev[1] if prev else inserted)
+
+    async def flush(self):
+        async with self.lock:
+            if not self.pending():
+                return
+
+            alert_requests = self.alert_requests
+            subscriptions = self.subscriptions
+            configs = self.guild_subscription_configs
+            self.alert_requests = {}
+            self.subscriptions = {}
+            self.guild_subscription_configs = {}
+
+            try:
+                await self.db.apply_batch(
+                    alert_upserts=[r for r, _ in alert_requests.values() if r],
+                    alert_deletes=[k for k, (r, _) in alert_requests.items() if not r],
+                    subscription_inserts=[
+                        k for k, (r, _) in subscriptions.items() if r
+                    ],
+                    subscription_deletes=[
+                        k for k, (r, _) in subscriptions.items() if not r
+                    ],
+                    config_upserts=[r for r, _ in configs.values()],
+                )
+            except:
+                # Put the batch back underneath anything staged since, so the
+                # next flush retries it
+                for staged, batch in [
+                    (self.alert_requests, alert_requests),
+                    (self.subscriptions, subscriptions),
+                    (self.guild_subscription_configs, configs),
+                ]:
+                    for k, v in batch.items():
+                        staged.setdefault(k, v)
+                raise
+
+    async def insert_alert_request(
+        self, user_id, guild_id, requester_id, channel_id, message_id, expires_at=None
+    ):
+        await self._stage(
+            self.alert_requests,
+            (user_id, guild_id, requester_id),
+            (user_id, guild_id, requester_id, channel_id, message_id, expires_at),
+            inserted=True,
+        )
+
+    async def upsert_alert_requests(self, rows):
+        # Not marked fresh: callers may be replacing rows that are already
+        # written, and a later delete of one of those must still reach the db
+        for row in rows:
+            self._stage_one(self.alert_requests, tuple(row[:3]), tuple(row))
+
+        if self.pending() >= self.max_pending:
+            await self.flush()
+
+    async def update_alert_request(
+        self, user_id, guild_id, requester_id, channel_id, message_id, expires_at=None
+    ):
+        await self._stage(
+            self.alert_requests,
+            (user_id, guild_id, requester_id),
+            (user_id, guild_id, requester_id, channel_id, message_id, expires_at),
+        )
+
+    async def remove_alert_request(self, user_id, guild_id, requester_id):
+        await self._stage(self.alert_requests, (user_id, guild_id, requester_id), None)
+
+    async def remove_alert_requests(self, keys):
+        for k in keys:
+            self._stage_one(self.alert_requests, tuple(k), None)
+
+        if self.pending() >= self.max_pending:
+            await self.flush()
+
+    async def insert_subscription(self, user_id, guild_id):
+        await self._stage(
+            self.subscriptions, (user_id, guild_id), (user_id, guild_id), inserted=True
+        )
+
+    async def insert_subscriptions(self, keys):
+        for k in keys:
+            self._stage_one(self.subscriptions, tuple(k), tuple(k), inserted=True)
+
+        if self.pending() >= self.max_pending:
+            await self.flush()
+
+    async def remove_subscription(self, user_id, guild_id):
+        await self._stage(self.subscriptions, (user_id, guild_id), None)
+
+    async def remove_subscriptions(self, keys):
+        for k in keys:
+            self._stage_one(self.subscriptions, tuple(k), None)
+
+        if self.pending() >= self.max_pending:
+            await self.flush()
+
+    async def upsert_guild_subscription_config(self, *row):
+        await self._stage(self.guild_subscription_configs, row[0], row)
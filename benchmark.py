@@ -0,0 +1,357 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import util
+from DBInterface import DBInterface
+from JournalStorage import JournalStorage
+from UserWatch import UserWatch
+from fakes import FakeGuild, FakeMessage
+from models import GuildSubscriptionConfig
+
+# Offline load benchmarks for UserWatch, DBInterface and util. Results are
+# written as a single JSON document so runs can be diffed over time, e.g.
+#
+#   python benchmark.py --messages 50000 --watched 2000 --output bench.json
+
+
+def summarize(samples, elapsed=None):
+    # samples: per-operation latencies in seconds
+    samples = sorted(samples)
+    n = len(samples)
+    if not n:
+        return {"count": 0}
+
+    def pct(p):
+        return samples[min(n - 1, int(p * n))] * 1e6
+
+    elapsed = elapsed if elapsed is not None else sum(samples)
+    return {
+        "count": n,
+        "ops_per_sec": n / elapsed if elapsed else None,
+        "mean_us": sum(samples) / n * 1e6,
+        "p50_us": pct(0.50),
+        "p99_us": pct(0.99),
+        "max_us": samples[-1] * 1e6,
+    }
+
+
+def peak_rss_kib():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB everywhere else
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def build_world(args, rng):
+    guilds = []
+    channel_id = 1 << 40
+    user_id = 2 << 40
+    for g in range(args.guilds):
+        guild = FakeGuild((3 << 40) + g)
+        for _ in range(args.channels):
+            guild.add_channel(channel_id, args.send_latency)
+            channel_id += 1
+        guilds.append(guild)
+
+    # (guild, member) for every watched user, plus a pool of unwatched authors
+    watched = []
+    for _ in range(args.watched):
+        guild = rng.choice(guilds)
+        watched.append((guild, guild.add_member(user_id)))
+        user_id += 1
+
+    unwatched = []
+    for _ in range(args.unwatched):
+        guild = rng.choice(guilds)
+        unwatched.append((guild, guild.add_member(user_id)))
+        user_id += 1
+
+    requesters = {}
+    for guild in guilds:
+        requesters[guild.id] = []
+        for _ in range(args.requesters):
+            requesters[guild.id].append(guild.add_member(user_id))
+            user_id += 1
+
+    return guilds, watched, unwatched, requesters
+
+
+async def arm(userwatch, guild, member, requesters, rng):
+    channels = list(guild.channels)
+    for r in requesters[guild.id]:
+        await userwatch.add_alert_request(
+            member.id, guild.id, r.id, rng.choice(channels), rng.getrandbits(62)
+        )
+
+
+async def bench_sightings(args, db_fp):
+    rng = random.Random(args.seed)
+    userwatch = UserWatch(
+        db_fp,
+        write_behind={"INTERVAL": 1.0} if args.write_behind else None,
+        send_concurrency=args.send_concurrency,
+        compact_state=args.compact,
+        dispatcher={} if args.dispatcher else None,
+        storage=storage_options(args, db_fp),
+    )
+    await userwatch.initialize()
+    try:
+        return await run_sightings(args, userwatch, rng)
+    except BaseException:
+        # Closed on errors too, or the storage's thread keeps the process up
+        await userwatch.close()
+        raise
+
+
+async def run_sightings(args, userwatch, rng):
+    guilds, watched, unwatched, requesters = build_world(args, rng)
+
+    setup_started = time.perf_counter()
+    for guild in guilds:
+        await userwatch.set_guild_subscription_channel(
+            guild.id, next(iter(guild.channels))
+        )
+    for guild, member in watched:
+        await arm(userwatch, guild, member, requesters, rng)
+        if rng.random() < args.subscribed:
+            await userwatch.add_subscription(member.id, guild.id)
+    setup_elapsed = time.perf_counter() - setup_started
+
+    latencies = {"unwatched": [], "watched": []}
+    started = time.perf_counter()
+    for i in range(args.messages):
+        if rng.random() < args.hit_rate:
+            guild, member = rng.choice(watched)
+            kind = "watched"
+        else:
+            guild, member = rng.choice(unwatched)
+            kind = "unwatched"
+
+        message = FakeMessage(
+            i, member, rng.choice(list(guild.channels.values())), content="hi"
+        )
+
+        t = time.perf_counter()
+        await userwatch.handle_user_sighting(member, guild, message)
+        latencies[kind].append(time.perf_counter() - t)
+
+        if args.rearm and kind == "watched":
+            await arm(userwatch, guild, member, requesters, rng)
+    elapsed = time.perf_counter() - started
+
+    # Closing waits for sends still in flight
+    memory = userwatch.store.memory_usage()
+    await userwatch.close()
+    sent = sum(len(c.sent) for g in guilds for c in g.channels.values())
+
+    return {
+        "setup_sec": setup_elapsed,
+        "elapsed_sec": elapsed,
+        "messages_per_sec": args.messages / elapsed if elapsed else None,
+        "sends": sent,
+        "state_bytes": memory,
+        "unwatched": summarize(latencies["unwatched"]),
+        "watched": summarize(latencies["watched"]),
+    }
+
+
+async def timed(samples, coro):
+    t = time.perf_counter()
+    await coro
+    samples.append(time.perf_counter() - t)
+
+
+def storage_options(args, db_fp):
+    if args.storage == "journal":
+        return {"BACKEND": "journal", "PATH": db_fp + ".journal"}
+    return None
+
+
+def open_db(args, db_fp):
+    if args.storage == "journal":
+        return JournalStorage(db_fp + ".journal")
+    return DBInterface(db_fp)
+
+
+async def bench_db(args, db_fp):
+    db = open_db(args, db_fp)
+    try:
+        await db.connect()
+        await db.initialize_database()
+        results = await run_db(args, db)
+    finally:
+        # Closed on errors too, or the storage's thread keeps the process up
+        await db.close()
+
+    # Cold start: reopen and read back everything written above
+    started = time.perf_counter()
+    db = open_db(args, db_fp)
+    try:
+        await db.initialize_database()
+        rows = 0
+        async for chunk in db.iter_table("alert_requests"):
+            rows += len(chunk)
+        results["iter_table"] = {
+            "rows": rows,
+            "elapsed_sec": time.perf_counter() - started,
+        }
+    finally:
+        await db.close()
+
+    return results
+
+
+async def run_db(args, db):
+    rng = random.Random(args.seed)
+    n = args.db_ops
+    keys = [
+        (rng.getrandbits(62), rng.getrandbits(62), rng.getrandbits(62))
+        for _ in range(n)
+    ]
+    results = {}
+
+    samples = []
+    for k in keys:
+        await timed(samples, db.insert_alert_request(*k, 1, 2))
+    results["insert_alert_request"] = summarize(samples)
+
+    samples = []
+    for k in keys:
+        await timed(samples, db.update_alert_request(*k, 3, 4))
+    results["update_alert_request"] = summarize(samples)
+
+    samples = []
+    for k in keys[: n // 2]:
+        await timed(samples, db.remove_alert_request(*k))
+    results["remove_alert_request"] = summarize(samples)
+
+    samples = []
+    rest = keys[n // 2 :]
+    for i in range(0, len(rest), args.batch):
+        await timed(samples, db.remove_alert_requests(rest[i : i + args.batch]))
+    results["remove_alert_requests"] = summarize(samples)
+    results["remove_alert_requests"]["batch"] = args.batch
+
+    samples = []
+    for k in keys:
+        await timed(samples, db.insert_subscription(*k[:2]))
+    results["insert_subscription"] = summarize(samples)
+
+    samples = []
+    for k in keys:
+        await timed(samples, db.remove_subscription(*k[:2]))
+    results["remove_subscription"] = summarize(samples)
+
+    samples = []
+    for k in keys:
+        await timed(
+            samples,
+            db.upsert_guild_subscription_config(
+                *GuildSubscriptionConfig(k[1], k[2], 5.0, 10).row()
+            ),
+        )
+    results["upsert_guild_subscription_config"] = summarize(samples)
+
+    samples = []
+    for i in range(0, n, args.batch):
+        rows = [(*k, 5, 6, None) for k in keys[i : i + args.batch]]
+        await timed(samples, db.apply_batch(alert_upserts=rows))
+    results["apply_batch"] = summarize(samples)
+    results["apply_batch"]["batch"] = args.batch
+
+    return results
+
+
+def bench_embeds(args):
+    rng = random.Random(args.seed)
+    guild = FakeGuild(1)
+    channel = guild.add_channel(2)
+    authors = [guild.add_member(10 + i) for i in range(args.embed_authors)]
+
+    samples = []
+    for i in range(args.embed_messages):
+        message = FakeMessage(i, rng.choice(authors), channel, content="x" * 200)
+        t = time.perf_counter()
+        util.build_message_embed(message)
+        samples.append(time.perf_counter() - t)
+
+    return summarize(samples)
+
+
+async def main(args):
+    report = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "params": vars(args),
+    }
+
+    # UserWatch reports to stdout, which is reserved for the JSON report
+    with tempfile.TemporaryDirectory() as d, contextlib.redirect_stdout(sys.stderr):
+        if "sightings" in args.suites:
+            report["sightings"] = await bench_sightings(
+                args, os.path.join(d, "sightings.db")
+            )
+        if "db" in args.suites:
+            report["db"] = await bench_db(args, os.path.join(d, "db.db"))
+
+        if "embeds" in args.suites:
+            report["embeds"] = bench_embeds(args)
+
+    report["peak_rss_kib"] = peak_rss_kib()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as o:
+            o.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline load benchmarks.")
+    parser.add_argument("--suites", nargs="+", default=["sightings", "db", "embeds"])
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--seed", type=int, default=0)
+
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--guilds", type=int, default=50)
+    parser.add_argument("--channels", type=int, default=5, help="per guild")
+    parser.add_argument("--watched", type=int, default=1000)
+    parser.add_argument("--unwatched", type=int, default=10000)
+    parser.add_argument(
+        "--requesters", type=int, default=3, help="alert requests per watched user"
+    )
+    parser.add_argument(
+        "--subscribed", type=float, default=0.1, help="fraction of watched users"
+    )
+    parser.add_argument(
+        "--hit-rate",
+        type=float,
+        default=0.05,
+        help="fraction of messages from watched users",
+    )
+    parser.add_argument(
+        "--rearm", action="store_true", help="re-add alerts after each one fires"
+    )
+    parser.add_argument("--send-latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--send-concurrency", type=int, default=5)
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--dispatcher", action="store_true")
+    parser.add_argument("--storage", choices=["sqlite", "journal"], default="sqlite")
+
+    parser.add_argument("--db-ops", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=50)
+
+    parser.add_argument("--embed-messages", type=int, default=20000)
+    parser.add_argument("--embed-authors", type=int, default=50)
+
+    asyncio.run(main(parser.parse_args()))
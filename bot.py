@@ -1,4 +1,5 @@
 import datetime
+import io
 import traceback
 import sys
 
@@ -7,6 +8,8 @@ import disnake as discord
 from disnake.ext import commands
 
 from UserWatch import UserWatch
+from Metrics import metrics
+from Trace import TraceRecorder
 from models import OperationStatus
 import util
 
@@ -21,19 +24,68 @@ with open("config.yml", "r") as o:
     config = load(o.read(), Loader=Loader)
 
 
-bot = commands.Bot(
-    intents=discord.Intents(members=True, guilds=True, guild_messages=True)
+sharding = config.get("SHARDING")
+
+
+metrics_config = config.get("METRICS")
+if metrics_config:
+    metrics.enabled = True
+
+
+class WatchBot(commands.AutoShardedBot if sharding else commands.Bot):
+    async def close(self):
+        await metrics.close()
+        await self.userwatch.close()
+        if self.trace:
+            self.trace.close()
+        await super().close()
+
+
+shard_options = {}
+if sharding:
+    # SHARD_COUNT may be omitted to use Discord's recommended count, and
+    # SHARD_IDS to run every shard in this process
+    shard_options = dict(
+        shard_count=sharding.get("SHARD_COUNT"), shard_ids=sharding.get("SHARD_IDS")
+    )
+
+bot = WatchBot(
+    intents=discord.Intents(members=True, guilds=True, guild_messages=True),
+    **shard_options,
 )
 
 bot.timestamp = None
-bot.userwatch = UserWatch(config["DATABASE_FILEPATH"])
+bot.trace = None
+bot.userwatch = UserWatch(
+    config["DATABASE_FILEPATH"],
+    write_behind=config.get("WRITE_BEHIND"),
+    send_concurrency=config.get("SEND_CONCURRENCY", 5),
+    compact_state=config.get("COMPACT_STATE", False),
+    dispatcher=config.get("DISPATCHER"),
+    sighting_queue=(config.get("SIGHTING_QUEUE") or {}).get("FILEPATH"),
+    storage=config.get("STORAGE"),
+    webhooks=config.get("SUBSCRIPTION_WEBHOOKS"),
+    intake=config.get("INTAKE"),
+)
 
 
 @bot.event
 async def on_ready():
     print(f"Running on {bot.user.name}#{bot.user.discriminator} ({bot.user.id})")
     if not bot.timestamp:
-        await bot.userwatch.initialize()
+        await bot.userwatch.initialize(bot.shard_count, getattr(bot, "shard_ids", None))
+
+        if metrics_config and metrics_config.get("PORT"):
+            await metrics.serve(
+                metrics_config.get("HOST", "127.0.0.1"), metrics_config["PORT"]
+            )
+
+        # Record traffic for replay.py from the state just loaded onwards
+        trace_config = config.get("TRACE")
+        if trace_config:
+            bot.trace = TraceRecorder(trace_config.get("FILEPATH", "trace.jsonl.gz"))
+            bot.trace.attach(bot.userwatch)
+            print(f"Recording a trace to {bot.trace.fp}")
 
         bot.timestamp = (
             datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).timestamp()
@@ -42,10 +94,19 @@ async def on_ready():
 
 @bot.event
 async def on_message(message):
+    metrics.inc("messages")
+
     # Wait for bot initialization to complete before accepting inputs
     if not bot.timestamp:
         return
 
+    if bot.trace:
+        bot.trace.message(message)
+
+    # Nearly every message comes from someone nobody is watching
+    if message.author.id not in bot.userwatch.watched_users:
+        return
+
     # Ignore DMs
     if not isinstance(message.channel, discord.abc.GuildChannel):
         return
@@ -54,7 +115,70 @@ async def on_message(message):
     if message.author.bot:
         return
 
-    await bot.userwatch.handle_user_sighting(message.author, message.guild, message)
+    if bot.userwatch.intake:
+        bot.userwatch.submit_sighting(message)
+        return
+
+    with metrics.timer("on_message"):
+        await bot.userwatch.handle_user_sighting(message.author, message.guild, message)
+
+
+# Keep cached permissions in step with the events that can change them, and
+# drop watch state that can never fire again
+
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    bot.userwatch.permissions.invalidate_channel(after)
+
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    bot.userwatch.permissions.invalidate_channel(channel)
+    await bot.userwatch.purge_channel(channel.guild.id, channel.id)
+
+
+@bot.event
+async def on_guild_role_create(role):
+    bot.userwatch.permissions.invalidate_guild(role.guild.id)
+
+
+@bot.event
+async def on_guild_role_update(before, after):
+    bot.userwatch.permissions.invalidate_guild(after.guild.id)
+
+
+@bot.event
+async def on_guild_role_delete(role):
+    bot.userwatch.permissions.invalidate_guild(role.guild.id)
+
+
+@bot.event
+async def on_guild_update(before, after):
+    bot.userwatch.permissions.invalidate_guild(after.id)
+
+
+@bot.event
+async def on_guild_remove(guild):
+    bot.userwatch.permissions.invalidate_guild(guild.id)
+
+    res = await bot.userwatch.purge_guild(guild.id)
+    alerts, subscriptions = res.data
+    if alerts or subscriptions:
+        print(
+            f"Left {guild.id}; dropped {alerts} alert requests and {subscriptions} subscriptions."
+        )
+
+
+@bot.event
+async def on_member_update(before, after):
+    bot.userwatch.permissions.invalidate_member(after.guild.id, after.id)
+
+
+@bot.event
+async def on_member_remove(member):
+    bot.userwatch.permissions.invalidate_member(member.guild.id, member.id)
+    await bot.userwatch.purge_requester(member.guild.id, member.id)
 
 
 def has_manage_guild(ctx):
@@ -79,6 +203,89 @@ def has_manage_roles(ctx):
     )
 
 
+async def read_bulk_users(ctx, users, file, resolve=True):
+    # Resolves the users given to a bulk command, from the text option and an
+    # optional uploaded list. Returns (users, failures), or None after replying
+    # with an error.
+    file_text = ""
+    if file:
+        # Checked before downloading, which could outlast the interaction
+        if file.size > util.MAX_BULK_FILE_BYTES:
+            await ctx.response.send_message(
+                f"Error: That file is too large; at most {util.MAX_BULK_USERS} users can be given at once."
+            )
+            return None
+        file_text = (await file.read()).decode("utf-8", "replace")
+
+    user_search = util.get_users(
+        ctx if resolve else None, util.parse_user_list(users, file_text)
+    )
+    if user_search.status != OperationStatus.SUCCESS:
+        await ctx.response.send_message(f"Error: {user_search.data}")
+        return None
+
+    return user_search.data
+
+
+def expiry_message(expires_at, plural=False):
+    if not expires_at:
+        return ""
+    if plural:
+        return f" These requests lapse <t:{int(expires_at)}:R>."
+    return f" This request lapses <t:{int(expires_at)}:R>."
+
+
+def alert_list_page(guild_id, requester_id, after):
+    # Content and buttons for a page of a requester's alert requests, or of
+    # the whole guild's if requester_id is None
+    rows, next_after = bot.userwatch.list_alert_requests(guild_id, requester_id, after)
+
+    if requester_id:
+        kind = "alerts"
+        lines = ["Alert requests you have made here:"]
+        if not rows:
+            lines = ["You have no alert requests here."]
+    else:
+        kind = "guild-alerts"
+        lines = ["Alert requests in this server:"]
+        if not rows:
+            lines = ["There are no alert requests in this server."]
+    if not rows and after is not None:
+        lines = ["There are no more alert requests."]
+
+    for u, r, c, _, expires_at in rows:
+        line = f"- <@{u}>" if requester_id else f"- <@{u}> for <@{r}>"
+        line += f" in <#{c}>"
+        if expires_at:
+            line += f", lapses <t:{int(expires_at)}:R>"
+        lines.append(line)
+
+    return "\n".join(lines), util.build_list_rows(kind, after, next_after)
+
+
+def subscription_list_page(guild_id, after):
+    users, next_after = bot.userwatch.list_subscriptions(guild_id, after)
+
+    lines = ["Subscriptions in this server:"]
+    if not users:
+        lines = ["There are no subscriptions in this server."]
+        if after is not None:
+            lines = ["There are no more subscriptions."]
+    lines.extend(f"- <@{u}>" for u in users)
+
+    return "\n".join(lines), util.build_list_rows("subscriptions", after, next_after)
+
+
+def bulk_response(lines, failures):
+    if failures:
+        lines.append(f"Skipped {len(failures)}:")
+        lines.extend(f"- `{t[:32]}`: {e}" for t, e in failures[:10])
+        if len(failures) > 10:
+            lines.append(f"- and {len(failures) - 10} more")
+
+    return "\n".join(lines)[:2000]
+
+
 @bot.slash_command()
 async def alert(ctx):
     pass
@@ -94,6 +301,11 @@ async def add_alert(
     user: str = commands.Param(
         # description="ID or @mention of the user to track."
     ),
+    expires_in: float = commands.Param(
+        default=0,
+        ge=0,
+        # description="Hours before the request lapses. 0 uses the server's default."
+    ),
 ):
     user_search = util.get_user(ctx, user)
 
@@ -103,8 +315,9 @@ async def add_alert(
 
     u = user_search.data
 
+    expires_at = bot.userwatch.get_alert_expiry(ctx.guild.id, expires_in * 3600)
     res = await bot.userwatch.add_alert_request(
-        u.id, ctx.guild.id, ctx.author.id, ctx.channel.id, ctx.id
+        u.id, ctx.guild.id, ctx.author.id, ctx.channel.id, ctx.id, expires_at
     )
 
     response = f"Alright, I will notify you here {{}}the next time I see <@{u.id}> say something."
@@ -117,6 +330,7 @@ async def add_alert(
             previous_channel_msg = f"(instead of <#{res.data}>) "
 
     response = response.format(previous_channel_msg)
+    response += expiry_message(expires_at)
 
     await ctx.response.send_message(response)
 
@@ -150,6 +364,149 @@ async def cancel_alert(
     await ctx.response.send_message(response)
 
 
+@alert.sub_command(
+    name="add-bulk",
+    # description="Request to be alerted when any of several users speaks."
+)
+@commands.check(has_manage_roles)
+async def add_alert_bulk(
+    ctx,
+    users: str = commands.Param(
+        default="",
+        # description="IDs or @mentions of the users to track."
+    ),
+    file: discord.Attachment = commands.Param(
+        default=None,
+        # description="Text file with one user ID per line."
+    ),
+    expires_in: float = commands.Param(
+        default=0,
+        ge=0,
+        # description="Hours before the requests lapse. 0 uses the server's default."
+    ),
+):
+    bulk = await read_bulk_users(ctx, users, file)
+    if not bulk:
+        return
+
+    found, failures = bulk
+
+    expires_at = bot.userwatch.get_alert_expiry(ctx.guild.id, expires_in * 3600)
+    res = await bot.userwatch.add_alert_requests(
+        [u.id for u in found],
+        ctx.guild.id,
+        ctx.author.id,
+        ctx.channel.id,
+        ctx.id,
+        expires_at,
+    )
+    inserted, updated = res.data
+
+    lines = []
+    if inserted:
+        lines.append(
+            f"Alright, I will notify you here the next time I see any of {util.mention_list(inserted)} say something."
+        )
+    if updated:
+        lines.append(
+            f"I was already monitoring {util.mention_list(updated)} for you, and will now notify you here."
+        )
+    if lines:
+        lines[-1] += expiry_message(expires_at, plural=True)
+
+    await ctx.response.send_message(bulk_response(lines, failures))
+
+
+@alert.sub_command(
+    name="cancel-bulk",
+    # description="Cancel previous alert requests for several users."
+)
+@commands.check(has_manage_roles)
+async def cancel_alert_bulk(
+    ctx,
+    users: str = commands.Param(
+        default="",
+        # description="IDs or @mentions of the users to stop tracking."
+    ),
+    file: discord.Attachment = commands.Param(
+        default=None,
+        # description="Text file with one user ID per line."
+    ),
+):
+    bulk = await read_bulk_users(ctx, users, file, resolve=False)
+    if not bulk:
+        return
+
+    found, failures = bulk
+
+    res = await bot.userwatch.remove_alert_requests(
+        [(u, ctx.guild.id, ctx.author.id) for u in found]
+    )
+
+    lines = ["I am not currently monitoring any of those users for you."]
+    if res.status == OperationStatus.SUCCESS:
+        removed = [k[0] for k in res.data]
+        lines = [
+            f"Alright, I will stop monitoring {util.mention_list(removed)} for you."
+        ]
+        if len(removed) < len(found):
+            lines.append(
+                f"I was not monitoring the other {len(found) - len(removed)} for you."
+            )
+
+    await ctx.response.send_message(bulk_response(lines, failures))
+
+
+@alert.sub_command(
+    name="list",
+    # description="List the alert requests you have made in this server."
+)
+@commands.check(has_manage_roles)
+async def list_alerts(
+    ctx,
+    everyone: bool = commands.Param(
+        default=False,
+        # description="List everyone's requests in this server. Needs Manage Server."
+    ),
+):
+    if everyone and not has_manage_guild(ctx):
+        await ctx.response.send_message(
+            f"Error: Insufficient permissions.", ephemeral=True
+        )
+        return
+
+    content, components = alert_list_page(
+        ctx.guild.id, None if everyone else ctx.author.id, None
+    )
+    await ctx.response.send_message(
+        content,
+        components=components,
+        ephemeral=True,
+        allowed_mentions=discord.AllowedMentions.none(),
+    )
+
+
+@alert.sub_command(
+    name="expiry",
+    # description="Set how long new alert requests in this server last by default."
+)
+@commands.check(has_manage_guild)
+async def set_alert_expiry(
+    ctx,
+    hours: float = commands.Param(
+        ge=0,
+        # description="Hours before new requests lapse. 0 keeps them until the user speaks."
+    ),
+):
+    await bot.userwatch.set_guild_alert_ttl(ctx.guild.id, hours * 3600)
+
+    response = "Alright, new alert requests will last until the user speaks."
+    if hours:
+        response = f"Alright, new alert requests will lapse after {hours:g} hours unless a different time is given."
+
+    await ctx.response.send_message(response)
+
+
 @bot.slash_command()
 async def subscription(ctx):
     pass
@@ -217,6 +574,102 @@ async def remove_subscription(
     await ctx.response.send_message(response)
 
 
+@subscription.sub_command(
+    name="start-bulk",
+    # description="Subscribe to several users' messages"
+)
+@commands.check(has_manage_guild)
+async def add_subscription_bulk(
+    ctx,
+    users: str = commands.Param(
+        default="",
+        # description="IDs or @mentions of the users to subscribe to"
+    ),
+    file: discord.Attachment = commands.Param(
+        default=None,
+        # description="Text file with one user ID per line."
+    ),
+):
+    bulk = await read_bulk_users(ctx, users, file)
+    if not bulk:
+        return
+
+    found, failures = bulk
+
+    res = await bot.userwatch.add_subscriptions([u.id for u in found], ctx.guild.id)
+    inserted, existing = res.data
+
+    subscription_channel = bot.userwatch.get_guild_subscription_channel(ctx.guild.id)
+
+    destination = "the ether, or at least until a subscription channel is set up"
+    if subscription_channel:
+        destination = f"<#{subscription_channel}>"
+
+    lines = []
+    if inserted:
+        lines.append(
+            f"Alright, I will now forward messages from {util.mention_list(inserted)} to {destination}."
+        )
+    if existing:
+        lines.append(
+            f"You are already subscribed to messages from {util.mention_list(existing)}."
+        )
+
+    await ctx.response.send_message(bulk_response(lines, failures))
+
+
+@subscription.sub_command(
+    name="stop-bulk",
+    # description="Unsubscribe from several users' messages"
+)
+@commands.check(has_manage_guild)
+async def remove_subscription_bulk(
+    ctx,
+    users: str = commands.Param(
+        default="",
+        # description="IDs or @mentions of the users to unsubscribe from"
+    ),
+    file: discord.Attachment = commands.Param(
+        default=None,
+        # description="Text file with one user ID per line."
+    ),
+):
+    bulk = await read_bulk_users(ctx, users, file, resolve=False)
+    if not bulk:
+        return
+
+    found, failures = bulk
+
+    res = await bot.userwatch.remove_subscriptions(found, ctx.guild.id)
+
+    lines = ["I am not currently forwarding messages from any of those users."]
+    if res.status == OperationStatus.SUCCESS:
+        lines = [
+            f"Alright, I will no longer forward messages from {util.mention_list(res.data)}."
+        ]
+        if len(res.data) < len(found):
+            lines.append(
+                f"I was not forwarding messages from the other {len(found) - len(res.data)}."
+            )
+
+    await ctx.response.send_message(bulk_response(lines, failures))
+
+
+@subscription.sub_command(
+    name="list",
+    # description="List the users subscribed to in this server"
+)
+@commands.check(has_manage_guild)
+async def list_subscriptions(ctx):
+    content, components = subscription_list_page(ctx.guild.id, None)
+    await ctx.response.send_message(
+        content,
+        components=components,
+        ephemeral=True,
+        allowed_mentions=discord.AllowedMentions.none(),
+    )
+
+
 @subscription.sub_command(
     name="set",
     # description="Set a channel to forward subscriptions to"
@@ -227,9 +680,22 @@ async def set_subscription_channel(
     channel: discord.TextChannel = commands.Param(
         # description="Select a channel to forward subscriptions to."
     ),
+    digest_window: float = commands.Param(
+        default=0,
+        ge=0,
+        # description="Batch forwarded messages for this many seconds. 0 forwards each one as it arrives."
+    ),
+    digest_size: int = commands.Param(
+        default=10,
+        ge=1,
+        le=10,
+        # description="Send a digest early once this many messages are waiting."
+    ),
 ):
 
-    res = await bot.userwatch.set_guild_subscription_channel(ctx.guild.id, channel.id)
+    res = await bot.userwatch.set_guild_subscription_channel(
+        ctx.guild.id, channel.id, digest_window, digest_size
+    )
 
     response = f"Alright, I will now forward messages from subscribed users to <#{channel.id}>{{}}."
     previous_channel_msg = ""
@@ -244,14 +710,94 @@ async def set_subscription_channel(
 
     response = response.format(previous_channel_msg)
 
+    if digest_window:
+        response += f" Messages will be sent in digests every {digest_window:g} seconds, or whenever {digest_size} are waiting."
+
+    if bot.userwatch.webhooks:
+        res = await bot.userwatch.enable_subscription_webhook(channel)
+        if res.status == OperationStatus.NOTFOUND:
+            response += " I couldn't create a webhook there; give me the Manage Webhooks permission, or free up a webhook slot, and run this again to forward through a webhook."
+
     await ctx.response.send_message(response)
 
 
+@bot.slash_command(
+    name="stats",
+    # description="Show the bot's internal counters and latencies."
+)
+@commands.is_owner()
+async def stats(ctx):
+    # The figures cover every server the bot is in, so only its owner sees them
+    await ctx.response.send_message(
+        f"```\n{metrics.summary()[:1900]}\n```", ephemeral=True
+    )
+
+
+@bot.slash_command(
+    name="export",
+    # description="Export everyone watched in this server as a CSV file."
+)
+@commands.check(has_manage_guild)
+async def export(ctx):
+    alert_requests, subscriptions = bot.userwatch.get_guild_watch_list(ctx.guild.id)
+
+    # user_id comes first so the file can be passed back to the bulk commands
+    lines = ["user_id,type,requester_id,channel_id"]
+    lines.extend(f"{u},alert,{r},{c}" for u, r, c, _ in alert_requests)
+    lines.extend(f"{u},subscription,," for u in subscriptions)
+
+    await ctx.response.send_message(
+        f"{len(alert_requests)} alert requests and {len(subscriptions)} subscriptions.",
+        file=discord.File(
+            io.BytesIO("\n".join(lines).encode()), f"watchlist-{ctx.guild.id}.csv"
+        ),
+        ephemeral=True,
+    )
+
+
+@bot.listen("on_button_click")
+async def turn_list_page(inter):
+    # Next/first page buttons on the list commands' responses. Permissions are
+    # checked again, since they may have changed since the list was opened.
+    button = util.parse_list_button(inter.data.custom_id)
+    if not button or not inter.guild:
+        return
+
+    kind, after = button
+    if kind == "alerts" and has_manage_roles(inter):
+        page = alert_list_page(inter.guild.id, inter.author.id, after)
+    elif kind == "guild-alerts" and has_manage_guild(inter):
+        page = alert_list_page(inter.guild.id, None, after)
+    elif kind == "subscriptions" and has_manage_guild(inter):
+        page = subscription_list_page(inter.guild.id, after)
+    else:
+        await inter.response.send_message(
+            f"Error: Insufficient permissions.", ephemeral=True
+        )
+        return
+
+    content, components = page
+    await inter.response.edit_message(
+        content,
+        components=components,
+        allowed_mentions=discord.AllowedMentions.none(),
+    )
+
+
 @add_alert.error
 @cancel_alert.error
+@add_alert_bulk.error
+@cancel_alert_bulk.error
+@list_alerts.error
+@set_alert_expiry.error
 @add_subscription.error
 @remove_subscription.error
+@add_subscription_bulk.error
+@remove_subscription_bulk.error
+@list_subscriptions.error
+@export.error
 @set_subscription_channel.error
+@stats.error
 async def process_error(ctx, error):
     if isinstance(error, commands.errors.CheckFailure):
         await ctx.response.send_message(
@@ -0,0 +1,97 @@
+import asyncio
+import datetime
+
+# Lightweight stand-ins for the disnake objects UserWatch and util touch, for
+# driving them offline. Channels record what would have been sent instead of
+# calling Discord.
+
+
+class FakePermissions:
+    def __init__(self, allowed=True):
+        self.send_messages = allowed
+        self.embed_links = allowed
+        self.read_messages = allowed
+
+
+class FakeAsset:
+    def __init__(self, user_id):
+        self.key = str(user_id % 5)
+        self.url = f"https://cdn.discordapp.com/embed/avatars/{self.key}.png"
+
+    def replace(self, **kwargs):
+        return self
+
+
+class FakeMember:
+    def __init__(self, user_id, bot=False):
+        self.id = user_id
+        self.name = f"user{user_id}"
+        self.discriminator = "0001"
+        self.color = 0
+        self.bot = bot
+        self.display_avatar = FakeAsset(user_id)
+
+
+class FakeTextChannel:
+    def __init__(self, channel_id, guild, send_latency=0):
+        self.id = channel_id
+        self.guild = guild
+        self.name = f"channel{channel_id}"
+        self.send_latency = send_latency
+        self.sent = []
+        self.allowed = True
+
+    def permissions_for(self, member):
+        return FakePermissions(self.allowed)
+
+    async def send(self, content=None, **kwargs):
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        self.sent.append((content, kwargs))
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.channels = {}
+        self.members = {}
+        self.me = FakeMember(0, bot=True)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    def add_channel(self, channel_id, send_latency=0):
+        channel = FakeTextChannel(channel_id, self, send_latency)
+        self.channels[channel_id] = channel
+        return channel
+
+    def add_member(self, user_id):
+        member = FakeMember(user_id)
+        self.members[user_id] = member
+        return member
+
+
+class FakeAttachment:
+    def __init__(self, attachment_id):
+        self.id = attachment_id
+        self.url = f"https://cdn.discordapp.com/attachments/{attachment_id}/file.png"
+
+
+class FakeMessage:
+    def __init__(
+        self, message_id, author, channel, content="", embeds=(), attachments=()
+    ):
+        self.id = message_id
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.embeds = list(embeds)
+        self.attachments = list(attachments)
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.jump_url = (
+            f"https://discord.com/channels/{self.guild.id}/{channel.id}/{message_id}"
+        )
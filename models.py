@@ -17,25 +17,38 @@ class CommandResponse:
         self.data = data
 
 
-class AlertRequest:
-    def __init__(self, user_id, guild_id, requester_id, channel_id, message_id):
-        self.user_id = user_id
-        self.guild_id = guild_id
-        self.requester_id = requester_id
-        self.channel_id = channel_id
-        self.message_id = message_id
-
-
-# You have to wonder if these two dataclasses are even needed if we're passing them from a tuple directly back to a tuple
-
-
-class Subscription:
-    def __init__(self, user_id, guild_id):
-        self.user_id = user_id
-        self.guild_id = guild_id
-
-
 class GuildSubscriptionConfig:
-    def __init__(self, guild_id, subscription_channel_id):
+    __slots__ = (
+        "guild_id",
+        "subscription_channel_id",
+        "digest_window",
+        "digest_size",
+        "alert_ttl",
+        "webhook_id",
+        "webhook_token",
+    )
+
+    def __init__(
+        self,
+        guild_id,
+        subscription_channel_id,
+        digest_window=None,
+        digest_size=None,
+        alert_ttl=None,
+        webhook_id=None,
+        webhook_token=None,
+    ):
         self.guild_id = guild_id
         self.subscription_channel_id = subscription_channel_id
+        # Seconds to buffer forwarded messages for, or None to forward each one
+        self.digest_window = digest_window
+        # Buffered messages that trigger an early digest
+        self.digest_size = digest_size
+        # Default lifetime in seconds of alert requests made in the guild
+        self.alert_ttl = alert_ttl
+        # Webhook in the subscription channel that forwards are sent through
+        self.webhook_id = webhook_id
+        self.webhook_token = webhook_token
+
+    def row(self):
+        return tuple(getattr(self, s) for s in self.__slots__)
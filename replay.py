@@ -0,0 +1,304 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+
+import disnake as discord
+
+from Metrics import metrics
+from Trace import TRACED_CALLS, read_trace
+from UserWatch import UserWatch
+from benchmark import peak_rss_kib, storage_options, summarize
+from fakes import FakeAttachment, FakeGuild, FakeMessage
+
+# Plays a trace recorded with the TRACE option back through UserWatch and its
+# storage, against stand-in guilds built from the IDs in the trace, and writes
+# a JSON report of latency and throughput, e.g.
+#
+#   python replay.py trace.jsonl.gz --speed 10 --output replay.json
+#
+# --speed 1 replays in real time, N at N times real time and 0 as fast as
+# possible. Records are handled one at a time, in order; at a fixed speed the
+# report's max_lag_sec shows how far handling fell behind the recording.
+
+# Argument positions of any guild, channel and requester IDs in traced calls,
+# so the stand-in guilds have what the calls refer to
+CALL_GUILD = {
+    "add_alert_request": 1,
+    "add_alert_requests": 1,
+    "remove_alert_request": 1,
+    "clear_alert_requests": 1,
+    "add_subscription": 1,
+    "add_subscriptions": 1,
+    "remove_subscription": 1,
+    "remove_subscriptions": 1,
+    "set_guild_subscription_channel": 0,
+    "set_guild_alert_ttl": 0,
+    "purge_guild": 0,
+    "purge_requester": 0,
+    "purge_channel": 0,
+}
+CALL_CHANNEL = {
+    "add_alert_request": 3,
+    "add_alert_requests": 3,
+    "set_guild_subscription_channel": 1,
+}
+CALL_REQUESTER = {
+    "add_alert_request": 2,
+    "add_alert_requests": 2,
+}
+# Absolute expiry times, which are moved to the same distance from replay time
+CALL_EXPIRES_AT = {
+    "add_alert_request": 5,
+    "add_alert_requests": 5,
+}
+
+
+class World:
+    # Stand-in guilds, channels and members, created as the trace names them
+
+    def __init__(self, send_latency):
+        self.send_latency = send_latency
+        self.guilds = {}
+
+    def guild(self, guild_id):
+        guild = self.guilds.get(guild_id)
+        if not guild:
+            guild = self.guilds[guild_id] = FakeGuild(guild_id)
+        return guild
+
+    def channel(self, guild, channel_id):
+        return guild.get_channel(channel_id) or guild.add_channel(
+            channel_id, self.send_latency
+        )
+
+    def member(self, guild, user_id):
+        return guild.get_member(user_id) or guild.add_member(user_id)
+
+    def prepare_call(self, name, args):
+        if name not in TRACED_CALLS:
+            raise ValueError(f"Unknown call {name} in trace")
+        if name not in CALL_GUILD:
+            return
+
+        guild = self.guild(args[CALL_GUILD[name]])
+        if name in CALL_CHANNEL and args[CALL_CHANNEL[name]]:
+            self.channel(guild, args[CALL_CHANNEL[name]])
+        if name in CALL_REQUESTER:
+            self.member(guild, args[CALL_REQUESTER[name]])
+
+    def message(self, guild_id, channel_id, author_id, message_id, embeds, attachments):
+        guild = self.guild(guild_id)
+        return FakeMessage(
+            message_id,
+            self.member(guild, author_id),
+            self.channel(guild, channel_id),
+            embeds=[
+                discord.Embed(description=f"{message_id}/{i}") for i in range(embeds)
+            ],
+            attachments=[FakeAttachment(message_id + i) for i in range(attachments)],
+        )
+
+    def sent(self):
+        return sum(
+            len(c.sent) for g in self.guilds.values() for c in g.channels.values()
+        )
+
+
+def shift_expiry(name, args, recorded_at, speed):
+    i = CALL_EXPIRES_AT.get(name)
+    if i is None or i >= len(args) or not args[i]:
+        return args
+
+    remaining = args[i] - recorded_at
+    if speed:
+        remaining /= speed
+
+    args = list(args)
+    args[i] = time.time() + remaining
+    return args
+
+
+def histogram_report():
+    # Bucketed, so quantiles are upper bounds
+    report = {}
+    for name, h in sorted(metrics.histograms.items()):
+        if h.count:
+            report[name] = {
+                "count": h.count,
+                "mean_us": h.sum / h.count * 1e6,
+                "p50_le_us": h.quantile(0.5) * 1e6,
+                "p99_le_us": h.quantile(0.99) * 1e6,
+            }
+    return report
+
+
+async def replay(args, db_fp):
+    metrics.enabled = True
+    userwatch = UserWatch(
+        db_fp,
+        write_behind={"INTERVAL": 1.0} if args.write_behind else None,
+        send_concurrency=args.send_concurrency,
+        compact_state=args.compact,
+        dispatcher={} if args.dispatcher else None,
+        storage=storage_options(args, db_fp),
+        intake={} if args.intake else None,
+    )
+    await userwatch.initialize()
+    try:
+        return await play(args, userwatch)
+    except BaseException:
+        # Closed on errors too, or the storage's thread keeps the process up
+        await userwatch.close()
+        raise
+
+
+async def drain(userwatch):
+    # Waits for the intake to hand over everything queued
+    while userwatch.intake and userwatch.intake.guilds:
+        await asyncio.sleep(0.01)
+
+
+async def play(args, userwatch):
+    world = World(args.send_latency)
+
+    records = read_trace(args.trace)
+    header = next(records)
+    started_at = header["started"]
+
+    # Recorded as (kind, t, ...); "i" records come first and set up state
+    # before the clock starts
+    setup_started = time.perf_counter()
+    setup_records = 0
+    record = next(records, None)
+    while record and record[0] == "i":
+        _, t, name, call_args = record
+        world.prepare_call(name, call_args)
+        await getattr(userwatch, name)(
+            *shift_expiry(name, call_args, started_at + t, 0)
+        )
+        setup_records += 1
+        record = next(records, None)
+    setup_elapsed = time.perf_counter() - setup_started
+
+    latencies = {"unwatched": [], "watched": []}
+    calls = {}
+    max_lag = 0
+    first_t = last_t = record[1] if record else 0
+
+    started = time.perf_counter()
+    while record:
+        kind, t = record[0], record[1]
+        last_t = t
+
+        if args.speed:
+            due = (t - first_t) / args.speed
+            lag = time.perf_counter() - started - due
+            if lag < 0:
+                await asyncio.sleep(-lag)
+            else:
+                max_lag = max(max_lag, lag)
+
+        if kind == "m":
+            message = world.message(*record[2:])
+            watched = message.author.id in userwatch.watched_users
+
+            s = time.perf_counter()
+            if userwatch.intake:
+                userwatch.submit_sighting(message)
+            else:
+                await userwatch.handle_user_sighting(
+                    message.author, message.guild, message
+                )
+            latencies["watched" if watched else "unwatched"].append(
+                time.perf_counter() - s
+            )
+
+        elif kind == "c":
+            _, _, name, call_args = record
+            world.prepare_call(name, call_args)
+            call_args = shift_expiry(name, call_args, started_at + t, args.speed)
+
+            s = time.perf_counter()
+            await getattr(userwatch, name)(*call_args)
+            calls.setdefault(name, []).append(time.perf_counter() - s)
+
+        record = next(records, None)
+    elapsed = time.perf_counter() - started
+
+    # Closing waits for sends still in flight
+    await drain(userwatch)
+    memory = userwatch.store.memory_usage()
+    await userwatch.close()
+    drained = time.perf_counter() - started
+
+    messages = len(latencies["unwatched"]) + len(latencies["watched"])
+    return {
+        "trace_started": datetime.datetime.fromtimestamp(
+            started_at, datetime.timezone.utc
+        ).isoformat(),
+        "trace_sec": last_t - first_t,
+        "setup_records": setup_records,
+        "setup_sec": setup_elapsed,
+        "elapsed_sec": elapsed,
+        "drained_sec": drained,
+        "max_lag_sec": max_lag,
+        "messages": messages,
+        "messages_per_sec": messages / elapsed if elapsed else None,
+        "guilds": len(world.guilds),
+        "sends": world.sent(),
+        "state_bytes": memory,
+        "unwatched": summarize(latencies["unwatched"]),
+        "watched": summarize(latencies["watched"]),
+        "calls": {name: summarize(samples) for name, samples in sorted(calls.items())},
+        "counters": dict(sorted(metrics.counters.items())),
+        "histograms": histogram_report(),
+    }
+
+
+async def main(args):
+    report = {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "params": vars(args),
+    }
+
+    # UserWatch reports to stdout, which is reserved for the JSON report
+    with tempfile.TemporaryDirectory() as d, contextlib.redirect_stdout(sys.stderr):
+        report["replay"] = await replay(args, os.path.join(d, "replay.db"))
+
+    report["peak_rss_kib"] = peak_rss_kib()
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as o:
+            o.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a recorded trace offline.")
+    parser.add_argument("trace")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=0,
+        help="multiple of real time, or 0 for as fast as possible",
+    )
+
+    parser.add_argument("--send-latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--send-concurrency", type=int, default=5)
+    parser.add_argument("--compact", action="store_true")
+    parser.add_argument("--write-behind", action="store_true")
+    parser.add_argument("--dispatcher", action="store_true")
+    parser.add_argument("--intake", action="store_true")
+    parser.add_argument("--storage", choices=["sqlite", "journal"], default="sqlite")
+
+    asyncio.run(main(parser.parse_args()))
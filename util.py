@@ -1,86 +1,162 @@
 from disnake.ext.commands.core import Command
 from models import OperationStatus, CommandResponse
+import functools
+import itertools
+import re
 import textwrap
+from collections import OrderedDict
 import disnake as discord
 
 
-def channel_accessible(channel):
+def channel_accessible(channel, permission_cache=None):
+    if not channel:
+        return channel
+
+    if permission_cache:
+        permissions = permission_cache.permissions_for(channel, channel.guild.me)
+    else:
+        permissions = channel.permissions_for(channel.guild.me)
+
+    return permissions.send_messages and permissions.embed_links
+
+
+# Forwarded messages from the same user usually carry the same header and the
+# same bot embeds, so both are memoized rather than rendered per message.
+AUTHOR_HEADER_CACHE_SIZE = 1024
+TEXTIFY_CACHE_SIZE = 256
+
+_author_headers = OrderedDict()
+
+
+def author_header(author):
+    # Returns (name, icon_url) for the embed author line
+    avatar = author.display_avatar
+    key = (author.id, avatar.key, author.name, author.discriminator)
+
+    header = _author_headers.get(key)
+    if header:
+        _author_headers.move_to_end(key)
+        return header
+
+    header = (
+        f"{author.name}#{author.discriminator}",
+        avatar.replace(size=1024, format="png").url,
+    )
+    _author_headers[key] = header
+    if len(_author_headers) > AUTHOR_HEADER_CACHE_SIZE:
+        _author_headers.popitem(last=False)
+
+    return header
+
+
+def embed_content(embed):
+    # Everything textify_embed reads from an embed, as a hashable tuple
     return (
-        channel
-        and channel.permissions_for(channel.guild.me).send_messages
-        and channel.permissions_for(channel.guild.me).embed_links
+        embed.title,
+        embed.url,
+        embed.author.name if embed.author else None,
+        embed.description,
+        embed.thumbnail.url if embed.thumbnail else None,
+        tuple((f.name, f.value) for f in embed.fields),
+        embed.image.url if embed.image else None,
+        embed.footer.text if embed.footer else None,
     )
 
 
 def textify_embed(embed, limit=40, padding=0, pad_first_line=True):
+    return _textify_embed_content(embed_content(embed), limit, padding, pad_first_line)
+
+
+@functools.lru_cache(maxsize=TEXTIFY_CACHE_SIZE)
+def _textify_embed_content(content, limit, padding, pad_first_line):
+    title, url, author_name, description, thumbnail, fields, image, footer = content
+
     text_proc = []
-    title = ""
-    if embed.title:
-        title += embed.title
-        if embed.url:
-            title += " - "
-    if embed.url:
-        title += embed.url
-    if not title and embed.author:
-        title = embed.author.name
+    full_title = ""
     if title:
-        text_proc += [title, ""]
-    if embed.description:
-        text_proc += [embed.description, ""]
-    if embed.thumbnail:
-        text_proc += ["Thumbnail: " + embed.thumbnail.url, ""]
-    for f in embed.fields:
+        full_title += title
+        if url:
+            full_title += " - "
+    if url:
+        full_title += url
+    if not full_title:
+        full_title = author_name
+    if full_title:
+        text_proc += [full_title, ""]
+    if description:
+        text_proc += [description, ""]
+    if thumbnail:
+        text_proc += ["Thumbnail: " + thumbnail, ""]
+    for name, value in fields:
         text_proc += [
-            f.name
+            name
             + (
                 ":"
-                if not f.name.endswith(("!", ")", "}", "-", ":", ".", "?", "%", "$"))
+                if not name.endswith(("!", ")", "}", "-", ":", ".", "?", "%", "$"))
                 else ""
             ),
-            *f.value.split("\n"),
+            *value.split("\n"),
             "",
         ]
-    if embed.image:
-        text_proc += ["Image: " + embed.image.url, ""]
-    if embed.footer:
-        text_proc += [embed.footer.text, ""]
+    if image:
+        text_proc += ["Image: " + image, ""]
+    if footer:
+        text_proc += [footer, ""]
 
-    text_proc = [textwrap.wrap(t, width=limit) for t in text_proc]
+    indent = " " * padding
+    border = "─" * limit
 
-    texts = []
+    lines = [" " * (padding * pad_first_line) + "╓─" + border + "─╮"]
+    for p in text_proc:
+        for t in textwrap.wrap(p, width=limit) or [""]:
+            lines.append(indent + "║ " + t.ljust(limit) + " │")
 
-    for tt in text_proc:
-        if not tt:
-            tt = [""]
-        for t in tt:
-            texts += [t + " " * (limit - len(t))]
+    # Every paragraph is followed by a blank line; the last one is replaced by the border
+    if len(lines) > 1:
+        lines.pop()
 
-    ret = " " * (padding * pad_first_line) + "╓─" + "─" * limit + "─╮"
+    lines.append(indent + "╙─" + border + "─╯")
 
-    for t in texts[:-1]:
-        ret += "\n" + " " * padding + "║ " + t + " │"
+    return "\n".join(lines)
 
-    ret += "\n" + " " * padding + "╙─" + "─" * limit + "─╯"
 
-    return ret
+def shard_id(guild_id, shard_count):
+    return (guild_id >> 22) % shard_count if shard_count else 0
 
 
-def build_jump_view(guild, channel, message_ids):
-    view = discord.ui.View()
+# Discord's limits on message components
+BUTTONS_PER_ROW = 5
+ROWS_PER_MESSAGE = 5
+BUTTONS_PER_MESSAGE = BUTTONS_PER_ROW * ROWS_PER_MESSAGE
 
-    for m in message_ids:
-        if m:
-            view.add_item(
-                discord.ui.Button(
-                    label="\u200b",
-                    url=f"https://discord.com/channels/{guild.id}/{channel.id}/{m}",
-                )
-            )
 
-    return view
+def build_jump_rows(guild, channel, message_ids):
+    # Link buttons back to each requester's message, as action rows for one
+    # message; at most BUTTONS_PER_MESSAGE message IDs can be passed. Link
+    # buttons never fire interactions, so there is no View to track them, and
+    # the rows are immutable and shared by identical sends.
+    return _jump_rows(guild.id, channel.id, tuple(message_ids))
+
+
+@functools.lru_cache(maxsize=1024)
+def _jump_rows(guild_id, channel_id, message_ids):
+    buttons = [
+        discord.ui.Button(
+            label="\u200b",
+            url=f"https://discord.com/channels/{guild_id}/{channel_id}/{m}",
+        )
+        for m in message_ids
+        if m
+    ]
+
+    return tuple(
+        discord.ui.ActionRow(*buttons[i : i + BUTTONS_PER_ROW])
+        for i in range(0, len(buttons), BUTTONS_PER_ROW)
+    )
 
 
 def build_message_embed(message):
+    author_name, author_icon_url = author_header(message.author)
     embed = (
         discord.Embed(
             title="\🔗",
@@ -89,13 +165,7 @@ def build_message_embed(message):
             color=message.author.color,
             timestamp=message.created_at,
         )
-        .set_author(
-            name=f"{message.author.name}#{message.author.discriminator}",
-            icon_url=message.author.display_avatar.replace(
-                size=1024,
-                format="png",
-            ).url,
-        )
+        .set_author(name=author_name, icon_url=author_icon_url)
         .set_footer(text=f"#{message.channel.name} • {message.author.id}")
     )
 
@@ -130,3 +200,130 @@ def get_user(ctx, user):
             )
 
     return CommandResponse(OperationStatus.SUCCESS, u)
+
+
+# Most users a single bulk command will act on
+MAX_BULK_USERS = 500
+# Largest uploaded user list read, about MAX_BULK_USERS lines of an export file
+MAX_BULK_FILE_BYTES = MAX_BULK_USERS * 100
+
+USER_TOKEN_SEPARATORS = re.compile(r"[\s,;]+")
+
+
+def parse_user_list(text="", file_text=""):
+    # Splits pasted IDs/mentions on whitespace, commas and semicolons. Uploaded
+    # lists are read one user per line, from the first column, so files from
+    # the export command can be fed back in; lines that don't start with an ID
+    # (like its header) are skipped.
+    tokens = [t for t in USER_TOKEN_SEPARATORS.split(text) if t]
+
+    for line in file_text.splitlines():
+        first = line.split(",", 1)[0].strip()
+        if first.strip("<@!>").isdigit():
+            tokens.append(first)
+
+    return tokens
+
+
+def get_users(ctx, tokens):
+    # get_user for many tokens at once. Returns a CommandResponse carrying
+    # (users, failures), where failures is a list of (token, error message).
+    # Duplicates are dropped.
+    if len(tokens) > MAX_BULK_USERS:
+        return CommandResponse(
+            OperationStatus.INVALID_ID,
+            f"Too many users; at most {MAX_BULK_USERS} can be given at once.",
+        )
+
+    users = []
+    failures = []
+    seen = set()
+    for token in tokens:
+        user_search = get_user(ctx, token)
+        if user_search.status != OperationStatus.SUCCESS:
+            failures.append((token, user_search.data))
+            continue
+
+        u = user_search.data
+        user_id = u.id if ctx else u
+        if user_id in seen:
+            continue
+        seen.add(user_id)
+        users.append(u)
+
+    if not users and not failures:
+        return CommandResponse(OperationStatus.INVALID_ID, "No users given.")
+
+    return CommandResponse(OperationStatus.SUCCESS, (users, failures))
+
+
+def mention_list(user_ids, limit=30):
+    # "<@1>, <@2> and 3 more", short enough for an interaction response
+    mentions = ", ".join(f"<@{u}>" for u in user_ids[:limit])
+    if len(user_ids) > limit:
+        mentions += f" and {len(user_ids) - limit} more"
+    return mentions
+
+
+# Watch list pages. Pages are cut by keyset rather than offset: the cursor is
+# the sort key of the last entry shown, so a page costs the same wherever it is
+# and entries added or removed in the meantime never shift the ones after it.
+LIST_PAGE_SIZE = 20
+LIST_BUTTON_PREFIX = "watchlist"
+
+
+def keyset_page(items, limit, key):
+    # Cuts a page from `items`, which must already be in key order and start
+    # just past the cursor. Returns the page and the cursor for the next one,
+    # or None. Reads at most limit + 1 items.
+    page = list(itertools.islice(items, limit + 1))
+    if len(page) > limit:
+        return page[:limit], key(page[limit - 1])
+
+    return page, None
+
+
+def build_list_rows(kind, after, next_after):
+    # First/next page buttons for a watch list page. Cursors are user or
+    # (user, requester) IDs, which keeps custom_id within Discord's 100 chars.
+    if after is None and next_after is None:
+        return []
+
+    def custom_id(cursor):
+        if cursor is None:
+            return f"{LIST_BUTTON_PREFIX}:{kind}:"
+        if isinstance(cursor, tuple):
+            cursor = ".".join(str(c) for c in cursor)
+        return f"{LIST_BUTTON_PREFIX}:{kind}:{cursor}"
+
+    return [
+        discord.ui.ActionRow(
+            discord.ui.Button(
+                label="First page",
+                custom_id=custom_id(None),
+                disabled=after is None,
+            ),
+            discord.ui.Button(
+                label="Next page",
+                custom_id=custom_id(next_after or after),
+                disabled=next_after is None,
+            ),
+        )
+    ]
+
+
+def parse_list_button(custom_id):
+    # (kind, cursor) from a build_list_rows button, or None for other buttons
+    prefix, _, rest = custom_id.partition(":")
+    if prefix != LIST_BUTTON_PREFIX:
+        return None
+
+    kind, _, cursor = rest.partition(":")
+    if not cursor:
+        return kind, None
+
+    try:
+        parts = tuple(int(c) for c in cursor.split("."))
+    except ValueError:
+        return None
+    return kind, parts if len(parts) > 1 else parts[0]
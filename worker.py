@@ -0,0 +1,177 @@
+import asyncio
+import sys
+import traceback
+
+import disnake as discord
+
+import util
+from DBInterface import DBInterface
+from Digest import DigestBuffer
+from Dispatch import DirectDispatcher, QueuedDispatcher, deliver
+from Metrics import metrics
+from SightingQueue import SightingQueue, RecordMessage
+
+# Notification worker for split mode. Claims sighting records pushed by the
+# gateway process (bot.py), renders and sends them over HTTP only, deletes
+# the alert requests they fulfilled and hands back those whose alert failed. Run as many of these as needed:
+#
+#   python worker.py
+
+
+class SightingWorker:
+    def __init__(self, db, queue, dispatcher, get_channel, batch_size=100):
+        self.db = db
+        self.queue = queue
+        self.dispatcher = dispatcher
+        self.digests = DigestBuffer(dispatcher)
+        # channel_id -> something with .id and .send, e.g. a PartialMessageable
+        self.get_channel = get_channel
+        self.batch_size = batch_size
+        self.settling = set()
+
+    async def run(self, poll_interval=0.05):
+        while True:
+            try:
+                processed = await self.process_batch()
+            except Exception as e:
+                print(
+                    "".join(traceback.TracebackException.from_exception(e).format()),
+                    file=sys.stderr,
+                )
+                processed = 0
+
+            if not processed:
+                await asyncio.sleep(poll_interval)
+
+    async def process_batch(self):
+        records = await self.queue.claim(self.batch_size)
+
+        for r in records:
+            task = asyncio.create_task(self.settle(r, self.process(r)))
+            self.settling.add(task)
+            task.add_done_callback(self.settling.discard)
+
+        return len(records)
+
+    async def settle(self, record, results):
+        # Delete the fulfilled requests once their alerts are out. The gateway
+        # already dropped them from memory, so requests whose alert failed to
+        # send are pushed back through the queue for it to restore; their rows
+        # are left in place.
+        claimed = {r: (m, e) for r, m, e in record["r"]}
+
+        failed = set()
+        restored = []
+        for (c, requester_ids, _), ok in zip(
+            record["a"], await asyncio.gather(*results)
+        ):
+            if ok:
+                continue
+            for r in requester_ids:
+                if r in claimed and r not in failed:
+                    failed.add(r)
+                    restored.append((record["u"], record["g"], r, c, *claimed[r]))
+
+        if restored:
+            await self.queue.push_restored(restored)
+            metrics.inc("claims_restored", len(restored))
+
+        fulfilled = [
+            (record["u"], record["g"], r, m)
+            for r, (m, _) in claimed.items()
+            if r not in failed
+        ]
+        if fulfilled:
+            await self.db.remove_fulfilled_alert_requests(fulfilled)
+
+    def process(self, record):
+        # Sends the record's notifications, returning a future per alert
+        metrics.inc("sightings")
+
+        subscription = None
+        if record["s"]:
+            channel_id, digest_window, digest_size = record["s"]
+            subscription = (self.get_channel(channel_id), digest_window, digest_size)
+
+        alerts = [
+            (self.get_channel(c), requester_ids, message_ids)
+            for c, requester_ids, message_ids in record["a"]
+        ]
+
+        if not (subscription or alerts):
+            return []
+
+        with metrics.timer("sighting_embed"):
+            embed = util.build_message_embed(RecordMessage(record["m"]))
+
+        return deliver(
+            self.dispatcher,
+            self.digests,
+            discord.Object(record["g"]),
+            embed,
+            subscription,
+            alerts,
+        )
+
+    async def close(self):
+        self.digests.flush_all()
+        await self.dispatcher.close()
+        if self.settling:
+            await asyncio.gather(*self.settling, return_exceptions=True)
+
+
+async def main():
+    from yaml import load
+
+    try:
+        from yaml import CLoader as Loader
+    except ImportError:
+        from yaml import Loader
+
+    with open("config.yml", "r") as o:
+        config = load(o.read(), Loader=Loader)
+
+    options = config.get("SIGHTING_QUEUE") or {}
+
+    # Log in over HTTP only; there is no gateway connection in this process
+    client = discord.Client()
+    await client.login(config["TOKEN"])
+
+    db = DBInterface(config["DATABASE_FILEPATH"])
+    await db.connect()
+    await db.initialize_database()
+
+    queue = SightingQueue(options.get("FILEPATH", "sightings.db"))
+    await queue.connect()
+
+    dispatcher = DirectDispatcher(config.get("SEND_CONCURRENCY", 5))
+    if config.get("DISPATCHER") is not None:
+        d = config["DISPATCHER"]
+        dispatcher = QueuedDispatcher(
+            config.get("SEND_CONCURRENCY", 5),
+            rate=d.get("CHANNEL_RATE", 5),
+            per=d.get("CHANNEL_PER", 5.0),
+            max_backlog=d.get("MAX_BACKLOG", 50),
+            policy=d.get("POLICY", "merge"),
+        )
+
+    worker = SightingWorker(
+        db,
+        queue,
+        dispatcher,
+        client.get_partial_messageable,
+        batch_size=options.get("BATCH_SIZE", 100),
+    )
+
+    print("Worker ready.")
+    try:
+        await worker.run(options.get("POLL_INTERVAL", 0.05))
+    finally:
+        await worker.close()
+        await queue.close()
+        await db.close()
+        await client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())